@@ -0,0 +1,246 @@
+"""Benchmark FileDownloader against a local stand-in HTTP server.
+
+A local aiohttp server, in its own process, serves synthetic files with
+configurable latency, per-connection bandwidth, Range support and random
+connection drops. The same files are downloaded with download_concurrently
+and download_individually, and every download is checked against the
+SHA-256 of what was served. A last run is killed part way through and then
+resumed, to check that resuming yields the right files without fetching
+everything again.
+
+USAGE EXAMPLES:
+$ python FileDownloaderBenchmark.py
+$ python FileDownloaderBenchmark.py --small 500 --large 0 --latency 0.05 --json bench.json
+$ python FileDownloaderBenchmark.py --large 4 --large-size 64 --bandwidth 8 --segments 4 --drop-rate 0.05
+"""
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+
+from aiohttp import web
+
+from rich.console import Console
+from rich.table import Table
+
+from file_downloader import FileDownloader, KiB, MiB
+console = Console(log_time=True, log_path=False)
+
+# Bytes written to a response between bandwidth sleeps and drop checks.
+SERVE_CHUNK = 64*KiB
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+def synthetic_files(args: argparse.Namespace) -> "dict[str, bytes]":
+    """The files the server serves; the same for the same arguments."""
+    rng = random.Random(args.seed)
+    sizes = [args.small_size * KiB] * args.small + [args.large_size * MiB] * args.large
+    return {f"file_{i:05d}.bin": rng.randbytes(size) for i, size in enumerate(sizes)}
+
+
+def serve(args: argparse.Namespace, port: int, ready, served) -> None:
+    """Server process: serve synthetic_files until terminated, counting the
+    body bytes sent in served."""
+    files = synthetic_files(args)
+    etags = {name: f'"{hashlib.sha256(data).hexdigest()[:16]}"' for name, data in files.items()}
+    rng = random.Random(args.seed)
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        if name not in files:
+            raise web.HTTPNotFound()
+        data, etag = files[name], etags[name]
+        headers = {"ETag": etag, "Last-Modified": LAST_MODIFIED}
+        start, end, status = 0, len(data), 200
+        if args.ranges:
+            headers["Accept-Ranges"] = "bytes"
+            range_header = request.headers.get("Range")
+            if range_header and request.headers.get("If-Range", etag) in (etag, LAST_MODIFIED):
+                first, _, last = range_header.removeprefix("bytes=").partition("-")
+                if first:
+                    start, end = int(first), min(int(last) + 1 if last else len(data), len(data))
+                else:
+                    start = max(0, len(data) - int(last))
+                if start >= len(data):
+                    raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{len(data)}"})
+                status = 206
+                headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(data)}"
+        await asyncio.sleep(args.latency)
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        drop_at = start + int((end - start) * rng.random()) if rng.random() < args.drop_rate else end + 1
+        position = start
+        while position < end:
+            size = min(SERVE_CHUNK, end - position, max(drop_at - position, 0))
+            if size == 0:
+                request.transport.close()
+                return response
+            await response.write(data[position:position + size])
+            served.value += size
+            position += size
+            if args.bandwidth:
+                await asyncio.sleep(size / (args.bandwidth * MiB))
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/files/{name}", handle)
+
+    async def main() -> None:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def download(links: dict, options: dict) -> "list[str]":
+    """Run a FileDownloader and return the names of the files it gave up on."""
+    return list(FileDownloader(links, **options).failed)
+
+
+def check(links: dict, expected: "dict[str, str]") -> int:
+    """Number of downloaded files whose SHA-256 matches what was served."""
+    correct = 0
+    for name, (_, file_path) in links.items():
+        if os.path.isfile(file_path):
+            with open(file_path, "rb") as local_file:
+                correct += hashlib.sha256(local_file.read()).hexdigest() == expected[name]
+    return correct
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    files = synthetic_files(args)
+    expected = {name: hashlib.sha256(data).hexdigest() for name, data in files.items()}
+    total_bytes = sum(len(data) for data in files.values())
+    port = free_port()
+    ready, served = multiprocessing.Event(), multiprocessing.Value("q", 0)
+    server = multiprocessing.Process(target=serve, args=(args, port, ready, served), daemon=True)
+    server.start()
+    ready.wait()
+    folder_path = args.folder or tempfile.mkdtemp(prefix="file_downloader_bench_")
+    options = {
+        "segments": args.segments, "max_concurrent": args.concurrency, "retries": args.retries,
+        "progress": args.progress,
+    }
+    report = {"files": len(files), "bytes": total_bytes, "modes": {}}
+    try:
+        def links_in(mode: str) -> dict:
+            shutil.rmtree(f"{folder_path}/{mode}", ignore_errors=True)
+            os.makedirs(f"{folder_path}/{mode}")
+            return {
+                name: [f"http://127.0.0.1:{port}/files/{name}", f"{folder_path}/{mode}/{name}"]
+                for name in files
+            }
+
+        for mode, concurrent in (("concurrently", True), ("individually", False)):
+            links = links_in(mode)
+            served.value = 0
+            wall, cpu = time.perf_counter(), time.process_time()
+            failed = download(links, {**options, "concurrent_downloads": concurrent})
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            report["modes"][mode] = {
+                "wall_s":     wall,
+                "mb_per_s":   total_bytes / MiB / wall,
+                "files_per_s": len(files) / wall,
+                "cpu_s_per_gb": cpu / (total_bytes / (1024 * MiB)),
+                "served_ratio": served.value / total_bytes,
+                "failed":     len(failed),
+                "correct":    check(links, expected),
+            }
+
+        # Kill a run part way through, then resume it.
+        links = links_in("resumed")
+        served.value = 0
+        interrupted = multiprocessing.Process(
+            target=download, args=(links, {**options, "concurrent_downloads": True})
+        )
+        interrupted.start()
+        interrupted.join(report["modes"]["concurrently"]["wall_s"] * args.interrupt_at)
+        interrupted.terminate()
+        interrupted.join()
+        before_resume = served.value
+        failed = download(links, {**options, "concurrent_downloads": True})
+        report["resume"] = {
+            "served_before_kill": before_resume / total_bytes,
+            "served_ratio":       served.value / total_bytes,
+            "failed":             len(failed),
+            "correct":            check(links, expected),
+        }
+    finally:
+        server.terminate()
+        if not args.keep and not args.folder:
+            shutil.rmtree(folder_path, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict) -> None:
+    table = Table(title=f"FileDownloader benchmark | {report['files']} files, {report['bytes'] / MiB:,.1f} MiB")
+    for column in ("Mode", "Wall (s)", "MB/s", "Files/s", "CPU s/GB", "Served/size", "Failed", "Correct"):
+        table.add_column(column, justify="left" if column == "Mode" else "right")
+    for mode, result in report["modes"].items():
+        table.add_row(
+            mode,
+            f"{result['wall_s']:.2f}",
+            f"{result['mb_per_s']:.1f}",
+            f"{result['files_per_s']:.1f}",
+            f"{result['cpu_s_per_gb']:.2f}",
+            f"{result['served_ratio']:.3f}",
+            str(result["failed"]),
+            f"{result['correct']}/{report['files']}",
+        )
+    console.print(table)
+    resume = report["resume"]
+    console.print(
+        f"Resume: {resume['served_before_kill']:.1%} served before the kill, "
+        f"{resume['served_ratio']:.3f}x the corpus served in total | "
+        f"{resume['failed']} failed | {resume['correct']}/{report['files']} correct"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--small", type=int, default=200, help="Small files served.")
+    parser.add_argument("--small-size", type=int, default=256, help="Size of the small files in KiB.")
+    parser.add_argument("--large", type=int, default=2, help="Large files served.")
+    parser.add_argument("--large-size", type=int, default=32, help="Size of the large files in MiB.")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds before each response starts.")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MiB/s per connection; 0 is unthrottled.")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of responses cut off part way.")
+    parser.add_argument("--no-ranges", dest="ranges", action="store_false", help="Ignore Range requests.")
+    parser.add_argument("--segments", type=int, default=1, help="FileDownloader segments.")
+    parser.add_argument("--concurrency", type=int, default=3, help="FileDownloader max_concurrent.")
+    parser.add_argument("--retries", type=int, default=3, help="FileDownloader retries.")
+    parser.add_argument("--progress", default="summary", choices=("rich", "summary", "jsonl", "none"),
+                        help="FileDownloader progress sink.")
+    parser.add_argument("--interrupt-at", type=float, default=0.5,
+                        help="Kill the resume run after this share of the concurrent run's time.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folder", help="Download here (kept) instead of a temporary folder.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary download folder.")
+    parser.add_argument("--json", help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file, indent=4)
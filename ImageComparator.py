@@ -9,30 +9,80 @@ run (199*200)/2 = 19,900 times.
 USAGE EXAMPLES:
 >>> pathy = "C:/Docs/Folder/Images"
 >>> ImageComparator(pathy).run_all() ## You can just do this.
->>> ImageComparator(pathy).read_images() ## To only read images. Will save in a pickle file in "C:/Docs/Folder/meta/.cache/xxx.pickle".
+>>> ImageComparator(pathy, top_k=20).run_all() ## Only compare each image against its 20 nearest neighbours.
+>>> ImageComparator(pathy, prefilter=True).run_all() ## Resolve near-identical copies by perceptual hash before SIFT.
+>>> ImageComparator(pathy, incremental=True).run_all() ## Only read and compare images added or changed since the last run.
+>>> ImageComparator(pathy, profile=ExtractionProfile(reduce=2, max_features=2000, quantize=True)).run_all() ## Cheaper, bounded descriptors.
+>>> ImageComparator(pathy, metrics=True, profiler="cprofile").run_all() ## Timings in "meta/metrics.jsonl", profile in "meta/profile.prof".
+>>> ImageComparator(pathy).read_images() ## To only read images. Uses a process pool, so call it under `if __name__ == "__main__":`. Will save descriptors in "C:/Docs/Folder/meta/.cache/descriptors.bin".
 >>> ImageComparator(pathy).compare_images() ## To only compare images. Will save in a JSON file in "C:/Docs/Folder/meta/similarities.json".
+>>> ImageComparator(pathy, min_similarity=0.1).run_all() ## Only keep pairs that are at least 10% similar.
+>>> ImageComparator(pathy, group_similarity=0.15).run_all() ## Group pairs at least 15% similar into duplicate sets with a keeper in "meta/duplicate_groups.csv".
+>>> ImageComparator(pathy, verify_similarity=0.2).run_all() ## Count RANSAC homography inliers for pairs that are at least 20% similar.
 """
 import os
+import csv
 import json
-import pickle
+import math
+import time
+import heapq
+import bisect
+import cProfile
+import hashlib
+import functools
+import threading
 import numpy as np
 import pandas as pd
-from typing import Literal
+from typing import Iterable, Iterator, Literal, Sequence
 
 import cv2
-from cv2 import cuda, SIFT, FlannBasedMatcher
+from cv2 import cuda, SIFT
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
+from itertools import islice
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, Future
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 
 from rich.console import Console
 from rich.progress import Progress, TimeElapsedColumn, TaskID
 console = Console(log_time=True, log_path=False)
 
 FLANN_INDEX_KDTREE = 1
+# Lowe's ratio test: a match is good if it is this much closer than the runner-up.
+RATIO_TEST = 0.7
+# Visual vocabulary used to pool SIFT descriptors into one vector per image.
+VOCABULARY_SIZE = 256
+# Total descriptors sampled (across all images) to train the vocabulary.
+VOCABULARY_TRAINING = 100_000
+# Images matched against a query image in a single matcher call.
+MATCH_BLOCK = 256
+# Tasks submitted to the executor per worker before waiting for results.
+IN_FLIGHT_PER_WORKER = 4
+# Pair results buffered in memory before they are appended to disk.
+RESULT_BUFFER = 65_536
+# Pair results sorted in memory at once when building the report.
+RESULT_RUN = 1 << 22
+RESULT_DTYPE = np.dtype([
+    ("id_1", "<i4"), ("id_2", "<i4"), ("matches", "<i4"), ("similarity", "<f4"), ("inliers", "<i4"),
+])
+# Bytes per stored keypoint: float32 (x, y).
+KEYPOINT_BYTES = 8
+# Max reprojection error, in pixels, for a match to count as a homography inlier.
+RANSAC_THRESHOLD = 5.0
+# Randomized KD-trees, and leaves visited per lookup, of the neighbour search index.
+ANN_TREES = 4
+ANN_CHECKS = 128
+# Perceptual hashes within this Hamming distance (of 64 bits) are duplicates.
+HASH_DISTANCE = 6
 # Leave some cores available for other things. :)
-CHUNK_SIZE = os.cpu_count() - 4
+CHUNK_SIZE = max(1, os.cpu_count() - 4)
+# SIFT extraction runs in processes, so it can use every core.
+EXTRACTION_WORKERS = os.cpu_count()
+# Threads prefetching image files, so slow (network) storage overlaps with SIFT.
+READ_WORKERS = 8
 
 def float_to_time_format(float_time: float) -> str:
     """Convert floating-point time to timedelta"""
@@ -42,6 +92,187 @@ def float_to_time_format(float_time: float) -> str:
     return base_time.strftime("%H:%M:%S")
 
 
+def file_digest(file_path: str) -> str:
+    """Return the BLAKE2b hex digest of a file's contents."""
+    digest = hashlib.blake2b()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class ExtractionProfile:
+    """How images are decoded and how many SIFT features are kept.
+
+    reduce: Decode at 1/reduce of the full resolution (IMREAD_REDUCED_GRAYSCALE_*).
+    max_side: Then shrink images whose longest side is larger. 0 keeps the size.
+    max_features: Keep only the strongest N keypoints. 0 keeps all of them.
+    quantize: Store descriptors as uint8. SIFT descriptor values are whole
+    numbers in [0, 255], so this is lossless and a quarter of the size.
+    """
+    reduce:       Literal[1, 2, 4, 8] = 1
+    max_side:     int = 0
+    max_features: int = 0
+    quantize:     bool = False
+
+
+DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+# Seconds between queue depth samples in the metrics file.
+QUEUE_SAMPLE_INTERVAL = 1.0
+
+
+# Per-process state of the SIFT extraction workers.
+_worker_sift: SIFT = None
+_worker_blocks: deque = None
+_worker_profile: ExtractionProfile = None
+
+
+def _init_extraction_worker(in_flight: int, profile: ExtractionProfile) -> None:
+    """Give every worker process its own SIFT detector."""
+    global _worker_sift, _worker_blocks, _worker_profile
+    _worker_profile = profile
+    _worker_sift = SIFT.create(nfeatures=profile.max_features)
+    # Windows frees shared memory once the last handle closes, so keep the
+    # blocks of results the parent may not have attached to yet.
+    _worker_blocks = deque(maxlen=in_flight)
+
+
+def _read_file(file_path: str, content_hash: bool = False) -> "tuple[bytes | None, str, float]":
+    """Prefetch stage: return the raw bytes of a file (None if unreadable),
+    their BLAKE2b hex digest if content_hash (else "") and the seconds spent
+    reading and hashing them."""
+    start = time.perf_counter()
+    try:
+        with open(file_path, "rb") as image_file:
+            data = image_file.read()
+    except OSError:
+        data = None
+    digest = hashlib.blake2b(data).hexdigest() if content_hash and data is not None else ""
+    return data, digest, time.perf_counter() - start
+
+
+def _extract_descriptors(data: bytes) -> "tuple[str, tuple, str, tuple, float, float] | None":
+    """Worker: decode an image file's bytes and hand its features back through
+    shared memory.
+
+    The block holds the (n, 128) descriptors followed by the (n, 2) float32
+    keypoint coordinates. Returns (shared memory name, descriptor shape,
+    descriptor dtype, (width, height), decode seconds, SIFT seconds) or None
+    if the image could not be decoded. The parent is responsible for
+    unlinking the block.
+    """
+    start = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), DECODE_FLAGS[_worker_profile.reduce]) if data else None
+    if img is None:
+        return None
+    # Of the full image; a reduced decode rounds it to a multiple of reduce.
+    resolution = (img.shape[1] * _worker_profile.reduce, img.shape[0] * _worker_profile.reduce)
+    longest_side = max(img.shape)
+    if _worker_profile.max_side and longest_side > _worker_profile.max_side:
+        scale = _worker_profile.max_side / longest_side
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    decoded = time.perf_counter()
+    keypoints, descriptor = _worker_sift.detectAndCompute(img, None)
+    timings = (decoded - start, time.perf_counter() - decoded)
+    if descriptor is None or descriptor.size == 0:
+        return ("", (0, 128), "<f4", resolution) + timings
+    points = cv2.KeyPoint_convert(keypoints).astype(np.float32, copy=False)
+    block = shared_memory.SharedMemory(create=True, size=descriptor.nbytes + points.nbytes)
+    np.ndarray(descriptor.shape, descriptor.dtype, buffer=block.buf)[:] = descriptor
+    np.ndarray(points.shape, np.float32, buffer=block.buf, offset=descriptor.nbytes)[:] = points
+    if os.name == "nt":
+        _worker_blocks.append(block)
+    else:
+        block.close()
+        # The parent unlinks the block, so this worker's resource tracker
+        # must not warn about it, or try to unlink it again, at shutdown.
+        resource_tracker.unregister(block._name, "shared_memory")
+    return (block.name, descriptor.shape, descriptor.dtype.str, resolution) + timings
+
+
+def _consume_descriptors(name: str, shape: tuple, dtype: str, consumer: callable) -> None:
+    """Hand the descriptors and keypoints in a worker's shared memory block to
+    consumer(descriptor, points), then free it.
+
+    consumer must not keep a reference to the arrays it is given.
+    """
+    if not name:
+        return consumer(None, None)
+    block = shared_memory.SharedMemory(name=name)
+    descriptor_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    try:
+        consumer(
+            np.ndarray(shape, dtype, buffer=block.buf),
+            np.ndarray((shape[0], 2), np.float32, buffer=block.buf, offset=descriptor_bytes),
+        )
+    finally:
+        block.close()
+        block.unlink()
+
+
+def perceptual_hash(file_path: str) -> "int | None":
+    """Return the 64-bit DCT perceptual hash (pHash) of an image."""
+    # A reduced decode is plenty for a 32x32 thumbnail and much faster.
+    img = cv2.imread(file_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        return None
+    thumbnail = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(thumbnail.astype(np.float32))[:8, :8].flatten()
+    # Skip the DC term so overall brightness doesn't decide the median.
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Burkhard-Keller tree of 64-bit hashes for Hamming-radius lookups."""
+    def __init__(self) -> None:
+        # Each node is [hash, items, {distance: child_node}].
+        self.root: list = None
+
+    def add(self, hash_value: int, item) -> None:
+        if self.root is None:
+            self.root = [hash_value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(node[0], hash_value)
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [hash_value, [item], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, hash_value: int, radius: int) -> "list[tuple[int, object]]":
+        """Return (distance, item) for every item within radius of hash_value."""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(node[0], hash_value)
+            if distance <= radius:
+                found += [(distance, item) for item in node[1]]
+            # Triangle inequality: only children in [d - r, d + r] can match.
+            nodes += [
+                child for edge, child in node[2].items()
+                if distance - radius <= edge <= distance + radius
+            ]
+        return found
+
+
 @dataclass(order=True)
 class ImageData:
     """Dataclass for storing image data."""
@@ -49,7 +280,15 @@ class ImageData:
     file_path:  str
     file_size:  int
     descriptor: np.ndarray = field(default=None)
-    gpu_mat:    cuda.GpuMat = field(default=None)
+    # (x, y) of the keypoint behind each descriptor row.
+    keypoints:  np.ndarray = field(default=None)
+    # Stable id of the image in the DescriptorStore.
+    index:      int = field(default=-1)
+    mtime:      int = field(default=0)
+    content_hash: str = field(default="")
+    # Pixels, filled in when the image is read. 0 if unknown.
+    width:      int = field(default=0)
+    height:     int = field(default=0)
 
     def __post_init__(self):
         object.__setattr__(self, "sort_index", self.name)
@@ -58,23 +297,430 @@ class ImageData:
         return f"{self.name} | {self.file_size}"
 
 
+class DescriptorStore:
+    """Append-only, memory-mapped store of SIFT descriptors.
+
+    descriptors.bin holds the descriptors of every image back to back as one
+    flat (rows, 128) array and keypoints.bin the matching (rows, 2) keypoint
+    coordinates. descriptor_index.jsonl has one line per image with its row
+    offset and count, so adding an image never rewrites existing data and
+    loading is reading the index and mapping the files. descriptor_store.json
+    records the layout, and whether the last read of the images finished.
+    """
+    def __init__(
+        self,
+        folder_path: str,
+        dtype: str = "float32",
+        width: int = 128,
+        profile: dict = None,
+    ) -> None:
+        """profile: The extraction settings the descriptors are made with.
+        Opening an existing store with different settings raises ValueError.
+        """
+        self.data_path  = f"{folder_path}/descriptors.bin"
+        self.keypoint_path = f"{folder_path}/keypoints.bin"
+        self.index_path = f"{folder_path}/descriptor_index.jsonl"
+        self.meta_path  = f"{folder_path}/descriptor_store.json"
+        if os.path.isfile(self.meta_path):
+            # An existing store keeps the layout it was created with.
+            with open(self.meta_path) as json_file:
+                meta = json.load(json_file)
+            if profile is not None and meta.get("profile", profile) != profile:
+                raise ValueError(
+                    f"Descriptors in {folder_path} were extracted with {meta['profile']}, "
+                    f"not {profile}. Delete that folder to re-extract them."
+                )
+            dtype, width = meta["dtype"], meta["width"]
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.profile = profile
+        self.row_bytes = self.dtype.itemsize * self.width
+        self.next_id = 0
+        # file_path -> latest index entry, filled by load().
+        self.entries: dict[str, dict] = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                self.next_id = sum(1 for _ in index_file)
+
+    def exists(self) -> bool:
+        return self.next_id > 0
+
+    def complete(self) -> bool:
+        """Whether the store holds a finished read. Stores from before this
+        was recorded count as finished."""
+        if not os.path.isfile(self.meta_path):
+            return False
+        with open(self.meta_path) as json_file:
+            return json.load(json_file).get("complete", True)
+
+    def mark_complete(self, complete: bool) -> None:
+        """Record whether a read of the images is underway or finished."""
+        meta = {"dtype": self.dtype.str, "width": self.width, "profile": self.profile, "complete": complete}
+        with open(self.meta_path + ".tmp", "w") as json_file:
+            json.dump(meta, json_file)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def append(self, image: ImageData, descriptor: "np.ndarray | None", points: "np.ndarray | None") -> None:
+        """Write an image's descriptors and keypoints at the end of the store and index them."""
+        if not os.path.isfile(self.meta_path):
+            self.mark_complete(False)
+        count = 0 if descriptor is None else len(descriptor)
+        offset = 0
+        if count:
+            with open(self.data_path, "ab") as data_file:
+                # Rows left behind by an interrupted write are simply skipped.
+                offset = data_file.tell() // self.row_bytes
+                data_file.seek(offset * self.row_bytes)
+                data_file.truncate()
+                data_file.write(np.ascontiguousarray(descriptor, dtype=self.dtype))
+            with open(self.keypoint_path, "ab") as keypoint_file:
+                keypoint_file.truncate(offset * KEYPOINT_BYTES)
+                keypoint_file.write(np.ascontiguousarray(points, dtype=np.float32))
+        # The index line goes last, so a crash never indexes missing rows.
+        image.index = self.next_id
+        self.next_id += 1
+        self._write_entry({
+            "id":           image.index,
+            "name":         image.name,
+            "file_path":    image.file_path,
+            "file_size":    image.file_size,
+            "mtime":        image.mtime,
+            "content_hash": image.content_hash,
+            "width":        image.width,
+            "height":       image.height,
+            "offset":       offset,
+            "count":        count,
+        })
+
+    def touch(self, image: ImageData) -> None:
+        """Record a new mtime for an image whose contents did not change."""
+        self._write_entry({**self.entries[image.file_path], "mtime": image.mtime})
+
+    def remove(self, file_path: str) -> None:
+        """Drop an image from the index. Its rows stay in the data file."""
+        self._write_entry({"file_path": file_path, "removed": True})
+
+    def _write_entry(self, entry: dict) -> None:
+        with open(self.index_path, "a") as index_file:
+            index_file.write(json.dumps(entry) + "\n")
+        if entry.get("removed"):
+            self.entries.pop(entry["file_path"], None)
+        else:
+            self.entries[entry["file_path"]] = entry
+
+    def load(self) -> "dict[str, ImageData]":
+        """Return every stored image with its descriptors as views of the mapped file."""
+        entries: dict[str, dict] = {}
+        with open(self.index_path) as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                if entry.get("removed"):
+                    entries.pop(entry["file_path"], None)
+                else:
+                    entries[entry["file_path"]] = entry
+        self.entries = entries
+        data = self._map(self.data_path, self.dtype, self.width)
+        points = self._map(self.keypoint_path, np.dtype(np.float32), 2)
+
+        def rows(column: "np.ndarray | None", entry: dict) -> "np.ndarray | None":
+            end = entry["offset"] + entry["count"]
+            return column[entry["offset"]:end] if entry["count"] and len(column) >= end else None
+
+        return {
+            path: ImageData(
+                name       = entry["name"],
+                file_path  = path,
+                file_size  = entry["file_size"],
+                descriptor = rows(data, entry),
+                keypoints  = rows(points, entry),
+                index      = entry["id"],
+                mtime      = entry.get("mtime", 0),
+                content_hash = entry.get("content_hash", ""),
+                width      = entry.get("width", 0),
+                height     = entry.get("height", 0),
+            )
+            for path, entry in entries.items()
+        }
+
+    @staticmethod
+    def _map(file_path: str, dtype: np.dtype, width: int) -> np.ndarray:
+        """Map a column file read-only as a (rows, width) array."""
+        row_bytes = dtype.itemsize * width
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) < row_bytes:
+            return np.empty((0, width), dtype=dtype)
+        column = np.memmap(file_path, dtype=np.uint8, mode="r")
+        return column[:len(column) - len(column) % row_bytes].view(dtype).reshape(-1, width)
+
+
+class ResultWriter:
+    """Append-only binary sink for pair results.
+
+    Results at or above min_similarity are buffered and appended to disk as
+    fixed-size RESULT_DTYPE records. The report is produced afterwards with
+    an external merge sort, so memory never grows with the number of pairs.
+    """
+    def __init__(self, file_path: str, min_similarity: float = 0.0) -> None:
+        self.file_path = file_path
+        self.min_similarity = min_similarity
+        self.lock = threading.Lock()
+        self.buffer: list[np.ndarray] = []
+        self.buffered = 0
+
+    def make_records(
+        self,
+        id_1: int,
+        ids_2: "list[int]",
+        matches: np.ndarray,
+        similarities: np.ndarray,
+        inliers: np.ndarray,
+    ) -> np.ndarray:
+        """Return the records of image id_1 against each image in ids_2 that are kept."""
+        keep = similarities >= self.min_similarity
+        records = np.zeros(np.count_nonzero(keep), dtype=RESULT_DTYPE)
+        records["id_1"] = id_1
+        records["id_2"] = np.asarray(ids_2)[keep]
+        records["matches"] = matches[keep]
+        records["similarity"] = similarities[keep]
+        records["inliers"] = inliers[keep]
+        return records
+
+    def add(self, records: np.ndarray) -> None:
+        """Buffer records made by make_records."""
+        with self.lock:
+            self.buffer.append(records)
+            self.buffered += len(records)
+            if self.buffered >= RESULT_BUFFER:
+                self._flush()
+
+    def flush(self) -> int:
+        """Write buffered results and return the size of the results file."""
+        with self.lock:
+            self._flush()
+        return os.path.getsize(self.file_path)
+
+    def _flush(self) -> None:
+        with open(self.file_path, "ab") as result_file:
+            for records in self.buffer:
+                records.tofile(result_file)
+        self.buffer, self.buffered = [], 0
+
+    def truncate(self, size: int = 0) -> None:
+        """Drop everything after size bytes, e.g. results past a checkpoint."""
+        with open(self.file_path, "ab") as result_file:
+            result_file.truncate(size)
+
+    def records(self) -> "Iterator[np.ndarray]":
+        """Yield the records in the order they were written, RESULT_BUFFER at a time."""
+        if not os.path.isfile(self.file_path):
+            return
+        total = os.path.getsize(self.file_path) // RESULT_DTYPE.itemsize
+        for start in range(0, total, RESULT_BUFFER):
+            yield np.fromfile(
+                self.file_path, dtype=RESULT_DTYPE,
+                count=min(RESULT_BUFFER, total - start), offset=start * RESULT_DTYPE.itemsize,
+            )
+
+    def sorted_records(self) -> "Iterator[np.void]":
+        """Yield every record by descending similarity using an external merge sort."""
+        runs = []
+        total = os.path.getsize(self.file_path) // RESULT_DTYPE.itemsize
+        for start in range(0, total, RESULT_RUN):
+            records = np.fromfile(
+                self.file_path, dtype=RESULT_DTYPE,
+                count=min(RESULT_RUN, total - start), offset=start * RESULT_DTYPE.itemsize,
+            )
+            records = records[np.argsort(-records["similarity"], kind="stable")]
+            runs.append(f"{self.file_path}.run{len(runs)}")
+            records.tofile(runs[-1])
+        try:
+            yield from heapq.merge(
+                *(self._read_run(run) for run in runs), key=lambda record: -record["similarity"]
+            )
+        finally:
+            for run in runs:
+                os.remove(run)
+
+    def _read_run(self, run_path: str) -> "Iterator[np.void]":
+        records = np.memmap(run_path, dtype=RESULT_DTYPE, mode="r")
+        for start in range(0, len(records), RESULT_BUFFER):
+            yield from np.array(records[start:start + RESULT_BUFFER])
+        del records
+
+
+class UnionFind:
+    """Disjoint sets of hashable items, with path halving and union by size.
+
+    Only items that were ever unioned are stored, so memory grows with the
+    number of images in duplicate groups, not the number of pairs.
+    """
+    def __init__(self) -> None:
+        self.parent: dict = {}
+        self.size: dict = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        while parent != item:
+            grandparent = self.parent[parent]
+            self.parent[item] = grandparent
+            item, parent = parent, grandparent
+        return item
+
+    def union(self, a, b) -> None:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        if self.size.get(root_a, 1) < self.size.get(root_b, 1):
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] = self.size.get(root_a, 1) + self.size.pop(root_b, 1)
+
+    def groups(self) -> "dict[object, list]":
+        """Map each set's root to its members."""
+        groups: dict = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
+
+
+class RunMetrics:
+    """Structured timing of an ImageComparator run, written as JSON lines.
+
+    Every line is an event: "phase" (wall and CPU seconds of a run phase),
+    "image" (read, decode and SIFT seconds of one image), "queue" (tasks in flight),
+    "checkpoint" (seconds spent saving) and "match_histogram" (pairs per
+    power-of-two bucket of per-pair matching microseconds). Without a
+    file_path every call is a no-op.
+    """
+    def __init__(self, file_path: "str | None" = None) -> None:
+        self.file = None if file_path is None else open(file_path, "a", buffering=1)
+        self.lock = threading.Lock()
+        self.match_histogram: dict[int, int] = {}
+        self.last_sample = 0.0
+
+    def emit(self, event: str, **fields) -> None:
+        if self.file is None:
+            return
+        line = json.dumps({"event": event, "time": time.time(), **fields})
+        with self.lock:
+            self.file.write(line + "\n")
+
+    @contextmanager
+    def phase(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.emit("phase", phase=name, wall_s=time.perf_counter() - wall, cpu_s=time.process_time() - cpu)
+
+    def record_match(self, seconds: float, pairs: int) -> None:
+        """Count pairs that were matched in a block taking seconds."""
+        if self.file is None or not pairs:
+            return
+        bucket = max(0, math.floor(math.log2(max(seconds / pairs * 1e6, 1))))
+        with self.lock:
+            self.match_histogram[bucket] = self.match_histogram.get(bucket, 0) + pairs
+
+    def flush_match_histogram(self) -> None:
+        with self.lock:
+            histogram, self.match_histogram = self.match_histogram, {}
+        self.emit("match_histogram", pairs_by_us={
+            f"{2 ** bucket}-{2 ** (bucket + 1)}": pairs for bucket, pairs in sorted(histogram.items())
+        })
+
+    def sample_queue(self, description: str, in_flight: int, **stages: int) -> None:
+        """Record how many tasks are in flight, and optionally how many are
+        in each pipeline stage, at most every QUEUE_SAMPLE_INTERVAL."""
+        now = time.perf_counter()
+        if self.file is None or now - self.last_sample < QUEUE_SAMPLE_INTERVAL:
+            return
+        self.last_sample = now
+        self.emit("queue", task=description, in_flight=in_flight, **stages)
+
+
+def timed_phase(name: str) -> callable:
+    """Decorator recording a method as a phase in the instance's RunMetrics."""
+    def decorator(method: callable) -> callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class ImageComparator:
     """Compare images to get duplicates."""
-    def __init__(self, folder_path:str, use_cuda: bool = True) -> None:
-        """folder_path: Path to the folder containing images."""
+    def __init__(
+        self,
+        folder_path:str,
+        use_cuda: bool = True,
+        top_k: int = 0,
+        prefilter: bool = False,
+        incremental: bool = False,
+        content_hash: bool = False,
+        min_similarity: float = 0.0,
+        verify_similarity: float = 0.0,
+        profile: ExtractionProfile = ExtractionProfile(),
+        metrics: bool = False,
+        profiler: Literal["cprofile", "pyinstrument"] = None,
+        group_similarity: float = 0.0,
+    ) -> None:
+        """folder_path: Path to the folder containing images.
+        top_k: Only compare each image against its top_k nearest neighbours
+        (by bag-of-visual-words embedding). 0 compares all pairs.
+        prefilter: Group near-identical images by perceptual hash first and
+        only send one image of each group through SIFT.
+        incremental: Rescan the folders and diff them against the descriptor
+        store by (path, size, mtime). Only new or changed images are read and
+        compared (against everything); removed images are dropped.
+        content_hash: With incremental, a file whose mtime changed but whose
+        size and BLAKE2b digest did not is treated as unchanged.
+        min_similarity: Only keep pairs at least this similar in the results.
+        verify_similarity: Verify pairs at least this similar by fitting a
+        RANSAC homography to their matches and report its inlier count.
+        0 skips verification.
+        profile: Decode resolution, keypoint cap and descriptor storage used
+        when reading images. See ExtractionProfile.
+        metrics: Write per-phase, per-image, queue depth, per-pair match time
+        and checkpoint timings to meta/metrics.jsonl. See RunMetrics.
+        profiler: Profile run_all with cProfile (meta/profile.prof) or
+        pyinstrument (meta/profile.html, needs `pip install pyinstrument`).
+        group_similarity: After comparing, join pairs at least this similar
+        (and perceptual hash duplicates) into duplicate groups with a keeper,
+        saved to meta/duplicate_groups. 0 skips grouping.
+        """
         self.folders = {
             "meta"   :f"{folder_path}/meta",
             "cache"  :f"{folder_path}/meta/.cache",
         }
         self.create_subfolders(self.folders)
+        self.metrics = RunMetrics(f"{self.folders['meta']}/metrics.jsonl" if metrics else None)
+        self.profiler = profiler
         self.files: dict[str, ImageData] = {}
         self.log_data = {}
         self.log_file = f"{self.folders['meta']}/similarities"
-        self.image_data_pkl: str = f"{self.folders['cache']}/image_data.pkl"
-        self.task_queue_pkl: str = f"{self.folders['cache']}/task_queue.pkl"
+        self.results = ResultWriter(f"{self.folders['cache']}/results.bin", min_similarity)
+        self.profile = profile
+        self.store = DescriptorStore(
+            self.folders["cache"],
+            dtype   = "uint8" if profile.quantize else "float32",
+            profile = asdict(profile),
+        )
+        self.cursor_json: str = f"{self.folders['cache']}/compare_cursor.json"
+        self.pending_json: str = f"{self.folders['cache']}/pending_compare.json"
+        self.candidates_npz: str = f"{self.folders['cache']}/candidates.npz"
+        self.hash_index_json: str = f"{self.folders['cache']}/phash_index.json"
+        self.hash_log_file = f"{self.folders['meta']}/phash_duplicates"
+        self.group_log_file = f"{self.folders['meta']}/duplicate_groups"
 
+        self.incremental  = incremental
+        self.content_hash = content_hash
+        # In incremental mode only these are compared: images read in this run,
+        # and those an interrupted run never finished comparing.
+        self.new_paths: set[str] = set()
         self.file_load = False
-        if not os.path.isfile(self.image_data_pkl):
+        # After an interrupted read, rescan so the images it never got to are read too.
+        if incremental or not self.store.complete():
             # Check for albums
             self.folders["images"] = [f"{folder_path}/Images"]
             if "Albums" in os.listdir(folder_path):
@@ -82,227 +728,750 @@ class ImageComparator:
                     if os.path.isdir(f"{folder_path}/Albums/{folder}"):
                         self.folders["images"] += [f"{folder_path}/Albums/{folder}"]
 
-            for image_folder in self.folders["images"]:
-                self.fetch_all_image_files(image_folder)
+            with self.metrics.phase("fetch_all_image_files"):
+                for image_folder in self.folders["images"]:
+                    self.fetch_all_image_files(image_folder)
+            self.new_paths = set(self.files)
+            if self.store.exists():
+                self._diff_against_store()
         else:
             self.file_load = True
-            self.files = self.pickle_and_save({}, self.image_data_pkl)
+            self.files = self.store.load()
+        self._save_pending()
 
         total_pics = len(self.files)
         if total_pics == 0:
             return console.print(f"Found {total_pics} image files.")
+        elif incremental:
+            runs = len(self.new_paths)*(total_pics-1) - len(self.new_paths)*(len(self.new_paths)-1)/2
+            console.print(f"Found {total_pics} images, {len(self.new_paths)} new or changed. This operation will run {runs:,.0f} times.\n")
         else:
             runs = ((total_pics-1)*total_pics)/2
             console.print(f"Found {total_pics} images. This operation will run {runs:,.0f} times.\n")
 
         self.use_cuda = use_cuda
-        self.sift     = SIFT.create()
+        self.top_k    = top_k
+        self.prefilter = prefilter
+        self.verify_similarity = verify_similarity
+        self.group_similarity = group_similarity
+        self.hashes: dict[str, list] = {}
+        # Representative image path -> paths of its perceptual duplicates.
+        self.hash_groups: dict[str, list[str]] = {}
+        # The perceptual duplicates taken out of self.files, by path.
+        self.hash_duplicates: dict[str, ImageData] = {}
         self.errors: dict[str, ImageData] = {}
-        self.prelim_results: dict[str, dict[str, str]] = {}
         if self.use_cuda:
             cuda.setDevice(0)
-            self.stream  = cuda.Stream()
             self.matcher = cuda.DescriptorMatcher.createBFMatcher(cv2.NORM_L2)
         else:
-            search_params = {"checks":50}
-            index_params  = {"algorithm":FLANN_INDEX_KDTREE, "trees":5}
-            self.flann    = FlannBasedMatcher(index_params, search_params)
+            self.search_params = {"checks":50}
+            self.index_params  = {"algorithm":FLANN_INDEX_KDTREE, "trees":5}
+
+    def _diff_against_store(self) -> None:
+        """Reuse stored descriptors for unchanged files and forget removed ones."""
+        stored = self.store.load()
+        removed = stored.keys() - self.files.keys()
+        for path in removed:
+            self.store.remove(path)
+        for path, image in self.files.items():
+            previous = stored.get(path)
+            if previous is None:
+                continue
+            if (previous.file_size, previous.mtime) != (image.file_size, image.mtime):
+                if not self.content_hash or previous.file_size != image.file_size:
+                    continue
+                image.content_hash = file_digest(path)
+                if image.content_hash != previous.content_hash:
+                    continue
+                previous.mtime = image.mtime
+                self.store.touch(previous)
+            self.files[path] = previous
+            self.new_paths.discard(path)
+        console.log(
+            f"{'Incremental scan' if self.incremental else 'Resuming an interrupted read'}: "
+            f"{len(self.new_paths)} new or changed, "
+            f"{len(removed)} removed, {len(self.files) - len(self.new_paths)} unchanged."
+        )
+
+    def _save_pending(self) -> None:
+        """Record, before anything is read, which images still need comparing
+        and the size of the results before their comparison began.
+
+        A run interrupted at any point leaves this behind, so the next
+        incremental run compares its images again (even those it got into
+        the store) after dropping whatever results it appended. A
+        non-incremental run compares everything, which "paths": None stands for.
+        """
+        pending = {}
+        if os.path.isfile(self.pending_json):
+            with open(self.pending_json) as json_file:
+                pending = json.load(json_file)
+        if not self.incremental:
+            self.base_size = 0
+        elif pending:
+            paths = pending["paths"]
+            self.new_paths.update(self.files if paths is None else (path for path in paths if path in self.files))
+            self.base_size = pending["base_size"]
+        else:
+            self.base_size = self.results.flush()
+        with open(self.pending_json + ".tmp", "w") as json_file:
+            json.dump({
+                "paths":     sorted(self.new_paths) if self.incremental else None,
+                "base_size": self.base_size,
+            }, json_file)
+        os.replace(self.pending_json + ".tmp", self.pending_json)
 
     def run_all(self):
+        if self.profiler == "cprofile":
+            profile = cProfile.Profile()
+            profile.runcall(self._run_all)
+            profile.dump_stats(f"{self.folders['meta']}/profile.prof")
+        elif self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            with Profiler() as profile:
+                self._run_all()
+            with open(f"{self.folders['meta']}/profile.html", "w") as html_file:
+                html_file.write(profile.output_html())
+        else:
+            self._run_all()
+
+    def _run_all(self):
         if not self.file_load:
+            if self.prefilter:
+                self.prefilter_duplicates()
             self.read_images()
         self.compare_images()
 
     def fetch_all_image_files(self, folder_path: str):
         """Gather all images into a list of ImageData objects."""
-        self.files.update({
-            f"{folder_path}/{file}": ImageData(
-                name = file,
-                file_path = f"{folder_path}/{file}",
-                file_size = os.stat(f"{folder_path}/{file}").st_size,
-            )
-            for file in os.listdir(folder_path)
-            if file.lower().endswith(
+        for entry in os.scandir(folder_path):
+            if entry.name.lower().endswith(
                 ('.jpeg', '.jpg', '.png', '.bmp', '.gif')
-            )
-        })
+            ):
+                stat = entry.stat()
+                self.files[f"{folder_path}/{entry.name}"] = ImageData(
+                    name = entry.name,
+                    file_path = f"{folder_path}/{entry.name}",
+                    file_size = stat.st_size,
+                    mtime = stat.st_mtime_ns,
+                )
 
     def _task_runner(
         self,
-        all_tasks:list,
+        all_tasks: "Iterable",
         function: callable,
         chunk_size:int = CHUNK_SIZE,
         task_description:str = "task",
-        quarterly:bool = False
+        quarterly:bool = False,
+        total_tasks:int = None,
+        on_done: callable = None,
     ) -> None:
-        """Cut up a list of tasks into manageable chunks and run them concurrently."""
+        """Run tasks concurrently, keeping only a few per worker in flight.
+
+        all_tasks may be a lazy iterable, which is only consumed as workers
+        free up. total_tasks: Progress bar total, when all_tasks has no length
+        or tasks advance the bar by more than one.
+        on_done(progress, task_id, item, result): Called in this thread as each
+        task finishes, with what function returned.
+        """
         if chunk_size > os.cpu_count():
             # Chunk must not exceed available CPU cores.
             raise ValueError("chunk_size is too high. Please reduce it.")
 
         if quarterly:
             self.quarters = [25, 50, 75, 100]
-            self.task_runner = all_tasks
-        total_tasks = len(all_tasks)
+        if total_tasks is None:
+            total_tasks = len(all_tasks)
         # Set up the progress bar.
         with Progress(
             TimeElapsedColumn(),
             *Progress.get_default_columns(),
             console=console,
         ) as progress, ThreadPoolExecutor(max_workers=chunk_size) as executor:
-                futures: list[Future] = []
+                pending: dict[Future, object] = {}
                 task = progress.add_task(
                     total = total_tasks,
                     description = task_description,
                 )
-                for item in all_tasks:
-                    futures.append(
-                        executor.submit(function, progress, task, item, quarterly)
-                    )
-                for future in futures:
-                    future.result()
-
-    def _image_reader(self, progress: Progress, task_id: TaskID, image: ImageData, quarterly:bool = False) -> None:
-        """Reads an image; extracts keypoints and descriptors."""
-        img = cv2.imread(image.file_path, cv2.IMREAD_GRAYSCALE)
-        if img is not None:
-            _, image.descriptor = self.sift.detectAndCompute(img, None)
+                queued = iter(all_tasks)
+                while True:
+                    for item in queued:
+                        pending[executor.submit(function, progress, task, item, quarterly)] = item
+                        if len(pending) >= IN_FLIGHT_PER_WORKER * chunk_size:
+                            break
+                    if not pending:
+                        break
+                    self.metrics.sample_queue(task_description, len(pending))
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item = pending.pop(future)
+                        result = future.result()
+                        if on_done is not None:
+                            on_done(progress, task, item, result)
+
+    def _image_reader(
+        self,
+        progress: Progress,
+        task_id: TaskID,
+        image: ImageData,
+        result: "tuple[str, tuple, str, tuple, float, float] | None",
+        read_s: float = 0.0,
+    ) -> None:
+        """Appends the descriptors a worker extracted for an image to the store."""
+        if result is not None:
+            name, shape, dtype, (image.width, image.height), decode_s, sift_s = result
+            _consume_descriptors(
+                name, shape, dtype, consumer=lambda descriptor, points: self.store.append(image, descriptor, points)
+            )
+            self.metrics.emit(
+                "image", name=image.name, read_s=read_s, decode_s=decode_s, sift_s=sift_s, keypoints=shape[0]
+            )
         else:
             progress.console.print(f"Could not read image: {image.name}")
-            self.errors[image.name] = image
+            self.errors[image.file_path] = image
         progress.update(task_id = task_id, description=f"Done reading image: {image.name}", advance=1)
-        if quarterly:
-            current_percentage = progress.tasks[task_id].completed / progress.tasks[task_id].total * 100
-            if self.quarters and current_percentage >= self.quarters[0]:
-                self.quarters.pop(0)
-                self.pickle_and_save(self.files, self.image_data_pkl, "wb")
-
-    def read_images(self):
-        """Read images from a folder."""
-        file_list = [image_data for _path, image_data in self.files.items()]
-        self._task_runner(
-            all_tasks = file_list,
-            function=self._image_reader,
-            task_description=f"reading images:",
-            quarterly = True
+
+    def _image_hasher(self, progress: Progress, task_id: TaskID, image: ImageData, quarterly:bool = False) -> None:
+        """Computes the perceptual hash of an image."""
+        stat = os.stat(image.file_path)
+        hash_value = perceptual_hash(image.file_path)
+        if hash_value is not None:
+            self.hashes[image.file_path] = [stat.st_size, stat.st_mtime_ns, f"{hash_value:016x}"]
+        progress.update(task_id = task_id, description=f"Done hashing image: {image.name}", advance=1)
+
+    @timed_phase("prefilter_duplicates")
+    def prefilter_duplicates(self) -> None:
+        """Resolve near-identical images by perceptual hash before any SIFT work.
+
+        Hashes are cached in meta/.cache/phash_index.json and only recomputed
+        for new or modified files. Within each group of images whose hashes
+        are at most HASH_DISTANCE bits apart, the largest file is kept for
+        SIFT comparison and the rest are reported in meta/phash_duplicates.
+        """
+        if os.path.isfile(self.hash_index_json):
+            with open(self.hash_index_json) as json_file:
+                self.hashes = json.load(json_file)
+        stale = []
+        for path, image in self.files.items():
+            stat = os.stat(path)
+            if self.hashes.get(path, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]:
+                stale.append(image)
+        if stale:
+            self._task_runner(
+                all_tasks = stale,
+                function=self._image_hasher,
+                task_description="hashing images",
+            )
+        # Forget files that are no longer in the folders.
+        self.hashes = {path: entry for path, entry in self.hashes.items() if path in self.files}
+        with open(self.hash_index_json, "w") as json_file:
+            json.dump(self.hashes, json_file)
+
+        tree = BKTree()
+        rows = []
+        # Largest files first, so each group is represented by its biggest copy.
+        for image in sorted(self.files.values(), key=lambda image: -image.file_size):
+            if image.file_path not in self.hashes:
+                continue
+            hash_value = int(self.hashes[image.file_path][2], 16)
+            matches = tree.search(hash_value, HASH_DISTANCE)
+            if not matches:
+                tree.add(hash_value, image)
+                self.hash_groups[image.file_path] = []
+                continue
+            distance, keeper = min(matches, key=lambda match: match[0])
+            self.hash_groups[keeper.file_path].append(image.file_path)
+            rows.append({
+                "pic1":       keeper.file_path,
+                "pic2":       image.file_path,
+                "size_1":     keeper.file_size,
+                "size_2":     image.file_size,
+                "distance":   distance,
+                "similarity": f"{1 - distance / 64:.6f}",
+            })
+
+        for duplicates in self.hash_groups.values():
+            for path in duplicates:
+                self.hash_duplicates[path] = self.files.pop(path)
+        pd.DataFrame(
+            rows, columns=["pic1", "pic2", "size_1", "size_2", "distance", "similarity"]
+        ).sort_values(by=["similarity"], ascending=False).to_csv(f"{self.hash_log_file}.csv", index=False)
+        console.log(
+            f"Perceptual hashing resolved {len(rows)} duplicates; "
+            f"{len(self.files)} images left for SIFT. Saved to: {self.hash_log_file}"
         )
-        for image in self.errors.keys():
-            self.files.pop(image)
-        self.pickle_and_save(self.files, self.image_data_pkl, "wb")
+
+    @timed_phase("read_images")
+    def read_images(self, workers: int = EXTRACTION_WORKERS, read_workers: int = READ_WORKERS):
+        """Read images from a folder.
+
+        Reading is a pipeline: read_workers threads prefetch the raw file
+        bytes, keeping a bounded number of files ahead of the extraction, and
+        a pool of worker processes, each with its own detector, decodes them
+        with cv2.imdecode and runs SIFT. Descriptors come back through shared
+        memory and the results are appended to the descriptor store as they
+        complete.
+        """
+        # Images already in the descriptor store don't need reading again.
+        file_list = [image_data for image_data in self.files.values() if image_data.index < 0]
+        if file_list:
+            self.store.mark_complete(False)
+        # Bound the submitted-but-uncollected work so shared memory stays small.
+        in_flight = 2 * workers
+        # Files being read or read and waiting for a worker; bounds the prefetched bytes.
+        read_ahead = in_flight
+        with Progress(
+            TimeElapsedColumn(),
+            *Progress.get_default_columns(),
+            console=console,
+        ) as progress, ThreadPoolExecutor(max_workers=read_workers) as reader, ProcessPoolExecutor(
+            max_workers = workers,
+            initializer = _init_extraction_worker,
+            initargs    = (in_flight, self.profile),
+        ) as executor:
+            task = progress.add_task(
+                total = len(file_list),
+                description = "reading images:",
+            )
+            reads: dict[Future, ImageData] = {}
+            prefetched: deque[tuple[ImageData, bytes, float]] = deque()
+            pending: dict[Future, tuple[ImageData, float]] = {}
+            queued = iter(file_list)
+            while True:
+                for image in islice(queued, read_ahead - len(reads) - len(prefetched)):
+                    # Hash the bytes already read, rather than reading the file twice.
+                    hash_it = self.content_hash and not image.content_hash
+                    reads[reader.submit(_read_file, image.file_path, hash_it)] = image
+                while prefetched and len(pending) < in_flight:
+                    image, data, read_s = prefetched.popleft()
+                    pending[executor.submit(_extract_descriptors, data)] = (image, read_s)
+                if not reads and not pending:
+                    break
+                self.metrics.sample_queue(
+                    "reading images", len(pending), reading=len(reads), prefetched=len(prefetched)
+                )
+                done, _ = wait([*reads, *pending], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in reads:
+                        image = reads.pop(future)
+                        data, digest, read_s = future.result()
+                        if digest:
+                            image.content_hash = digest
+                        if data is None:
+                            self._image_reader(progress, task, image, None)
+                        else:
+                            prefetched.append((image, data, read_s))
+                    else:
+                        image, read_s = pending.pop(future)
+                        self._image_reader(progress, task, image, future.result(), read_s)
+        self.store.mark_complete(True)
+        # Swap in descriptors backed by the store instead of worker copies.
+        stored = self.store.load() if self.store.exists() else {}
+        self.files = {path: stored[path] for path in self.files if path in stored}
         console.log(f"Done reading {len(self.files)} images.")
 
+    def _knn_match(self, train: np.ndarray, query: np.ndarray) -> "tuple[np.ndarray, np.ndarray]":
+        """Return the indices and L2 distances of the 2 nearest train descriptors
+        of every query descriptor, as (len(query), 2) arrays.
+        """
+        if not self.use_cuda:
+            # An index is built per block, so threads never share one.
+            index = cv2.flann_Index(train, self.index_params)
+            train_idx, distances = index.knnSearch(query, 2, params=self.search_params)
+            # FLANN reports squared L2 distances.
+            return train_idx, np.sqrt(distances)
+        stream = cuda.Stream()
+        gpu_train, gpu_query = cuda.GpuMat(), cuda.GpuMat()
+        gpu_train.upload(train, stream)
+        gpu_query.upload(query, stream)
+        gpu_matches = self.matcher.knnMatchAsync(gpu_query, gpu_train, k=2, stream=stream)
+        stream.waitForCompletion()
+        # For k=2 the result is a 2 x len(query) CV_32SC2 matrix: row 0 holds
+        # the train indices, row 1 the distances as float32.
+        raw = gpu_matches.download()
+        return raw[0], raw[1].view(np.float32)
+
+    def _match_block(
+        self,
+        image: ImageData,
+        others: "list[ImageData]",
+        with_indices: bool = False,
+    ) -> "tuple[np.ndarray, np.ndarray, list]":
+        """Match the descriptors of every image in others against image.
+
+        Returns the descriptor count and the number of good (ratio test)
+        matches of each other image. with_indices also returns, per pair, the
+        (other image rows, image rows) of its good matches.
+        """
+        counts = np.array(
+            [0 if other.descriptor is None else len(other.descriptor) for other in others], dtype=np.int64
+        )
+        good_counts = np.zeros(len(others), dtype=np.int64)
+        indices = [(np.empty(0, np.int64), np.empty(0, np.int64)) for _ in others] if with_indices else []
+        if image.descriptor is None or len(image.descriptor) < 2 or not counts.sum():
+            return counts, good_counts, indices
+
+        query = np.concatenate(
+            [other.descriptor for other in others if other.descriptor is not None]
+        ).astype(np.float32, copy=False)
+        train_idx, distances = self._knn_match(image.descriptor.astype(np.float32, copy=False), query)
+        good = (train_idx[:, 1] >= 0) & (distances[:, 0] < RATIO_TEST * distances[:, 1])
+
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        running = np.concatenate(([0], np.cumsum(good)))
+        good_counts = running[ends] - running[starts]
+        if with_indices:
+            rows = np.flatnonzero(good)
+            indices = [
+                (pair_rows - start, train_idx[pair_rows, 0].astype(np.int64))
+                for start, pair_rows in zip(starts, np.split(rows, np.searchsorted(rows, ends[:-1])))
+            ]
+        return counts, good_counts, indices
+
+    def _verify(
+        self,
+        image: ImageData,
+        other: ImageData,
+        other_rows: np.ndarray,
+        image_rows: np.ndarray,
+    ) -> int:
+        """Count the good matches of a pair that agree on a RANSAC homography."""
+        # A homography needs 4 correspondences; images stored without keypoints can't be verified.
+        if len(other_rows) < 4 or image.keypoints is None or other.keypoints is None:
+            return 0
+        _, mask = cv2.findHomography(
+            other.keypoints[other_rows], image.keypoints[image_rows], cv2.RANSAC, RANSAC_THRESHOLD
+        )
+        return 0 if mask is None else int(mask.sum())
+
     def _comparator(
         self,
         progress: Progress,
         task_id: TaskID,
-        task: "list[ImageData]",
+        task: "list[tuple[int, int], ImageData, list[ImageData]]",
         quarterly:bool = False
-    ) -> None:
-        """Compare two images using the SIFT algorithm."""
-        if not self.use_cuda:
-            matches = self.flann.knnMatch(task[1].descriptor, task[2].descriptor, k=2)
-        else:
-            matches = self.matcher.knnMatchConvert(
-                self.matcher.knnMatchAsync(
-                    task[1].gpu_mat, task[2].gpu_mat, k=2, stream=self.stream
-                )
+    ) -> np.ndarray:
+        """Compare one image against a block of images using the SIFT algorithm.
+
+        The index is built on the first image once, and the descriptors of
+        every other image are concatenated and matched against it in a single
+        call. The matches are then split back out per image, so each pair's
+        similarity is its share of descriptors passing the ratio test.
+        Returns the block's result records, which _block_done hands to the
+        ResultWriter.
+        """
+        _, image, others = task
+        start = time.perf_counter()
+        counts, good_counts, indices = self._match_block(image, others, with_indices=self.verify_similarity > 0)
+        similarities = good_counts / np.maximum(counts, 1)
+        inliers = np.full(len(others), -1, dtype=np.int64)
+        if self.verify_similarity > 0:
+            for k in np.flatnonzero(similarities >= self.verify_similarity):
+                inliers[k] = self._verify(image, others[k], *indices[k])
+        records = self.results.make_records(
+            image.index, [other.index for other in others], good_counts, similarities, inliers
+        )
+        self.metrics.record_match(time.perf_counter() - start, len(others))
+        progress.update(advance = len(others), task_id = task_id,
+            description = f"Done {image.name} vs {len(others)} images"
+        )
+        return records
+
+    def _build_vocabulary(self, images: "list[ImageData]") -> np.ndarray:
+        """Cluster a sample of SIFT descriptors into visual words."""
+        rng = np.random.default_rng(0)
+        per_image = max(1, VOCABULARY_TRAINING // max(1, len(images)))
+        samples = []
+        for image in images:
+            if image.descriptor is None or len(image.descriptor) == 0:
+                continue
+            rows = rng.choice(
+                len(image.descriptor), min(per_image, len(image.descriptor)), replace=False
             )
+            samples.append(image.descriptor[rows])
+        samples = np.vstack(samples).astype(np.float32)
+        # Seeded, so a resumed comparison generates the same candidates.
+        cv2.setRNGSeed(0)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+        _, _, vocabulary = cv2.kmeans(
+            samples, min(VOCABULARY_SIZE, len(samples)), None, criteria, 1, cv2.KMEANS_PP_CENTERS
+        )
+        return vocabulary
 
-        good_matches = [m for m, n in matches if m.distance < 0.7 * n.distance]
-        similarity = len(good_matches) / len(matches) if matches else 0
-        self.prelim_results[task[0]].update({
-            "matches": len(good_matches),
-            "similarity": f"{similarity:.6f}",
-        })
-        progress.update(advance = 1, task_id = task_id,
-            description = f"Done {task[1].name} vs {task[2].name}"
+    def _embed_images(self, images: "list[ImageData]") -> np.ndarray:
+        """Pool every image's descriptors into an L2-normalised tf-idf word histogram."""
+        vocabulary = self._build_vocabulary(images)
+        vocabulary_norms = (vocabulary ** 2).sum(axis=1)
+        histograms = np.zeros((len(images), len(vocabulary)), dtype=np.float32)
+        for row, image in enumerate(images):
+            if image.descriptor is None or len(image.descriptor) == 0:
+                continue
+            # Nearest word: argmin |d - c|^2 == argmin |c|^2 - 2 d.c
+            distances = vocabulary_norms - 2 * image.descriptor.astype(np.float32) @ vocabulary.T
+            words = distances.argmin(axis=1)
+            histograms[row] = np.bincount(words, minlength=len(vocabulary))
+
+        document_frequency = (histograms > 0).sum(axis=0)
+        idf = np.log((1 + len(images)) / (1 + document_frequency)).astype(np.float32)
+        embeddings = histograms / np.maximum(histograms.sum(axis=1, keepdims=True), 1) * idf
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def _candidate_partners(self, images: "list[ImageData]") -> "list[list[int]]":
+        """Return, for each image i, the sorted j > i where j is among the top_k
+        approximate nearest neighbours of i, or vice versa.
+
+        The embeddings are unit length, so the nearest by L2 distance are the
+        most cosine-similar. They are indexed with FLANN randomized KD-trees
+        and each lookup visits at most ANN_CHECKS leaves, so the search grows
+        with n log n rather than n^2. The trees are built randomly, so the
+        candidates are saved to meta/.cache/candidates.npz and a resumed
+        comparison reuses them.
+        """
+        total = len(images)
+        if os.path.isfile(self.candidates_npz):
+            saved = np.load(self.candidates_npz)
+            if str(saved["fingerprint"]) == self.fingerprint:
+                offsets = saved["offsets"]
+                return [js.tolist() for js in np.split(saved["partners"], offsets[1:-1])]
+        embeddings = self._embed_images(images)
+        index = cv2.flann_Index(embeddings, {"algorithm": FLANN_INDEX_KDTREE, "trees": ANN_TREES})
+        # One extra neighbour, as an image normally finds itself first.
+        neighbours, _ = index.knnSearch(embeddings, self.top_k + 1, params={"checks": ANN_CHECKS})
+        partners: "list[set[int]]" = [set() for _ in images]
+        for i, columns in enumerate(neighbours.tolist()):
+            for j in [j for j in columns if j != i and j >= 0][:self.top_k]:
+                partners[min(i, j)].add(max(i, j))
+        adjacency = [sorted(js) for js in partners]
+        kept = sum(len(js) for js in adjacency)
+        np.savez(
+            self.candidates_npz,
+            fingerprint = self.fingerprint,
+            offsets     = np.cumsum([0] + [len(js) for js in adjacency]),
+            partners    = np.fromiter((j for js in adjacency for j in js), dtype=np.int64, count=kept),
         )
-        if quarterly:
-            current_percentage = progress.tasks[task_id].completed / progress.tasks[task_id].total * 100
-            if self.quarters and current_percentage >= self.quarters[0]:
-                self.quarters.pop(0)
-                self.pickle_and_save(self.prelim_results, self.log_file, "wb", "json")
-                if not self.use_cuda:
-                    bookmark = self.task_runner.remove(task)
-                    self.pickle_and_save(bookmark, self.task_queue_pkl, "wb")
+        console.log(
+            f"Candidate generation kept {kept:,} of {total * (total - 1) // 2:,} pairs."
+        )
+        return adjacency
+
+    def _pair_blocks(
+        self,
+        images: "list[ImageData]",
+        partners: callable,
+        cursor: "tuple[int, int]",
+        done: "set[tuple[int, int]]",
+    ):
+        """Lazily yield [(i, j), image, block] comparison tasks in (i, j) order.
+
+        j is the offset of the block in partners(i). Blocks before cursor or
+        in done were completed by an earlier run and are skipped.
+        """
+        for i in range(cursor[0], len(images)):
+            others = partners(i)
+            for j in range(cursor[1] if i == cursor[0] else 0, len(others), MATCH_BLOCK):
+                if (i, j) in done:
+                    continue
+                self.open_blocks.add((i, j))
+                self.last_block = (i, j)
+                yield [(i, j), images[i], [images[k] for k in others[j:j + MATCH_BLOCK]]]
 
+    def _save_cursor(self) -> None:
+        """Checkpoint the results and the position of the comparison."""
+        start = time.perf_counter()
+        # Everything before the oldest unfinished block is done.
+        cursor = min(self.open_blocks) if self.open_blocks else self.last_block
+        self.done_blocks = {block for block in self.done_blocks if block >= cursor}
+        with open(self.cursor_json, "w") as json_file:
+            json.dump({
+                "fingerprint":  self.fingerprint,
+                "cursor":       cursor,
+                "done":         sorted(self.done_blocks),
+                "results_size": self.results.flush(),
+            }, json_file)
+        self.metrics.emit("checkpoint", seconds=time.perf_counter() - start, cursor=cursor)
+
+    def _block_done(self, progress: Progress, task_id: TaskID, task: list, records: np.ndarray) -> None:
+        """Record a finished block's results and checkpoint at every quarter.
+
+        Results only reach the ResultWriter here, as their block is marked
+        done, so a checkpoint never holds results of a block it will redo.
+        """
+        self.results.add(records)
+        self.open_blocks.discard(task[0])
+        self.done_blocks.add(task[0])
+        current_percentage = progress.tasks[task_id].completed / max(progress.tasks[task_id].total, 1) * 100
+        if self.quarters and current_percentage >= self.quarters[0]:
+            self.quarters.pop(0)
+            self._save_cursor()
+
+    @timed_phase("compare_images")
     def compare_images(self) -> None:
-        """Set up the images for comparison."""
-        image_tasks: "list[list[ImageData, ImageData]]" = []
-        images = [image_path for image_path in self.files.keys()]
+        """Set up the images for comparison.
 
-        c = 0
-        if not self.use_cuda:
-            if not os.path.isfile(self.task_queue_pkl):
-                for i in range(len(images)):
-                    for j in range(i+1, len(images)):
-                        image_tasks += [
-                            [c, self.files[images[i]], self.files[images[j]]]
-                        ]
-                        c += 1
-                self.pickle_and_save(image_tasks, self.task_queue_pkl, "wb")
-            else:
-                image_tasks = self.pickle_and_save({}, self.task_queue_pkl)
+        Pairs are generated lazily, one block of partners per task, and the
+        comparison can resume from the (image, partner offset) cursor saved in
+        meta/.cache/compare_cursor.json at every quarter.
+        """
+        # Sorted by store id, so positions are stable between runs.
+        images = sorted(self.files.values(), key=lambda image: image.index)
+        self.fingerprint = hashlib.blake2b(
+            np.array([image.index for image in images] + [self.top_k], dtype=np.int64).tobytes(),
+            digest_size=8,
+        ).hexdigest()
+        cursor, self.done_blocks = (0, 0), set()
+        saved = {}
+        if os.path.isfile(self.cursor_json):
+            with open(self.cursor_json) as json_file:
+                saved = json.load(json_file)
+        if saved.get("fingerprint") == self.fingerprint:
+            cursor = tuple(saved["cursor"])
+            self.done_blocks = {tuple(block) for block in saved["done"]}
+            # Results of blocks finished after the checkpoint are redone.
+            self.results.truncate(saved["results_size"])
+            console.log(f"Resuming comparison from image {cursor[0]}.")
         else:
-            for _, image_data in self.files.items():
-                gpu_mat = cuda.GpuMat()
-                gpu_mat.upload(image_data.descriptor)
-                image_data.gpu_mat = gpu_mat
-                # Cannot pickle the GpuMat object.
-                image_data.descriptor = None
-
-            for i in range(len(images)):
-                for j in range(i + 1, len(images)):
-                    image_tasks += [
-                        [c, self.files[images[i]], self.files[images[j]]]
-                    ]
-                    c += 1
-
-        for i in range(len(image_tasks)):
-            self.prelim_results[i] = {
-                "pic1":    image_tasks[i][1].file_path,
-                "pic2":    image_tasks[i][2].file_path,
-                "size_1":  image_tasks[i][1].file_size,
-                "size_2":  image_tasks[i][2].file_size,
-            }
+            # Drop anything an interrupted comparison of the pending images appended.
+            self.results.truncate(self.base_size)
+
+        adjacency = None
+        if self.top_k and self.top_k < len(images) - 1:
+            adjacency = self._candidate_partners(images)
+        new_positions = [i for i, image in enumerate(images) if image.file_path in self.new_paths]
+
+        def partners(i: int) -> "Sequence[int]":
+            """Positions j > i of the images to compare images[i] against."""
+            js = range(i + 1, len(images)) if adjacency is None else adjacency[i]
+            if not self.incremental or images[i].file_path in self.new_paths:
+                return js
+            # Pairs between two unchanged images were compared in an earlier run.
+            if adjacency is None:
+                return new_positions[bisect.bisect_right(new_positions, i):]
+            return [j for j in js if images[j].file_path in self.new_paths]
+
+        total_pairs = sum(len(partners(i)) for i in range(cursor[0], len(images)))
+        total_pairs -= cursor[1]
+        total_pairs -= sum(len(partners(i)[j:j + MATCH_BLOCK]) for i, j in self.done_blocks)
+
+        self.open_blocks: set[tuple[int, int]] = set()
+        self.last_block = cursor
         self._task_runner(
-            all_tasks = image_tasks,
+            all_tasks = self._pair_blocks(images, partners, cursor, self.done_blocks),
+            total_tasks = total_pairs,
             function=self._comparator,
             task_description="comparing images",
-            quarterly = True
+            quarterly = True,
+            on_done = self._block_done,
+        )
+        self.results.flush()
+        self.metrics.flush_match_histogram()
+        self.save_results(self.log_file)
+        if self.group_similarity:
+            self.group_duplicates(self.group_similarity)
+        for file_path in (self.cursor_json, self.candidates_npz, self.pending_json):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    @timed_phase("save_results")
+    def save_results(self, log_file_path: str) -> None:
+        """Write the results, most similar first, to a CSV and a JSON file.
+
+        Results involving images that were since removed or changed (their
+        store ids are no longer current) are left out.
+        """
+        images = {image.index: image for image in self.files.values()}
+        results_cols = [
+            "pic1", "pic2", "size_1", "size_2", "matches", "similarity", "inliers"
+        ]
+        with open(f"{log_file_path}.csv", "w", newline="") as csv_file, \
+                open(f"{log_file_path}.json", "w") as json_file:
+            writer = csv.DictWriter(csv_file, fieldnames=results_cols)
+            writer.writeheader()
+            json_file.write("{")
+            separator = "\n"
+            for record in self.results.sorted_records():
+                image_1, image_2 = images.get(int(record["id_1"])), images.get(int(record["id_2"]))
+                if image_1 is None or image_2 is None:
+                    continue
+                row = {
+                    "pic1":       image_1.file_path,
+                    "pic2":       image_2.file_path,
+                    "size_1":     image_1.file_size,
+                    "size_2":     image_2.file_size,
+                    "matches":    int(record["matches"]),
+                    "similarity": f"{record['similarity']:.6f}",
+                    "inliers":    int(record["inliers"]),
+                }
+                writer.writerow(row)
+                json_file.write(f'{separator}    "{image_1.index}-{image_2.index}": {json.dumps(row)}')
+                separator = ",\n"
+            json_file.write("\n}\n")
+        console.log(f"Saved comparison results to: {log_file_path}")
+
+    @timed_phase("group_duplicates")
+    def group_duplicates(self, min_similarity: float) -> None:
+        """Join duplicates into groups and pick the copy of each to keep.
+
+        Pairs at least min_similarity similar are streamed from the results
+        file into a union-find, together with the perceptual hash groups of
+        prefilter_duplicates, so the pairs are never all in memory. The keeper
+        of a group is its largest file, then its highest resolution. Groups
+        are saved, largest first, to a CSV with one row per image and a JSON
+        file of {keeper: [duplicates]}.
+        """
+        images = {image.index: image for image in self.files.values()}
+        by_path = {
+            **self.errors, **self.hash_duplicates, **{image.file_path: image for image in self.files.values()}
+        }
+        groups = UnionFind()
+        for records in self.results.records():
+            records = records[records["similarity"] >= min_similarity]
+            for id_1, id_2 in zip(records["id_1"].tolist(), records["id_2"].tolist()):
+                # Pairs of images that were since removed or changed are skipped.
+                if id_1 in images and id_2 in images:
+                    groups.union(images[id_1].file_path, images[id_2].file_path)
+        for keeper, duplicates in self.hash_groups.items():
+            for path in duplicates:
+                groups.union(keeper, path)
+
+        clusters = sorted(
+            (
+                sorted(
+                    (by_path[path] for path in members),
+                    key=lambda image: (image.file_size, image.width * image.height),
+                    reverse=True,
+                )
+                for members in groups.groups().values()
+            ),
+            key=len,
+            reverse=True,
+        )
+        group_cols = ["group", "pic", "size", "width", "height", "keeper"]
+        with open(f"{self.group_log_file}.csv", "w", newline="") as csv_file, \
+                open(f"{self.group_log_file}.json", "w") as json_file:
+            writer = csv.DictWriter(csv_file, fieldnames=group_cols)
+            writer.writeheader()
+            for group, members in enumerate(clusters):
+                for image in members:
+                    writer.writerow({
+                        "group":  group,
+                        "pic":    image.file_path,
+                        "size":   image.file_size,
+                        "width":  image.width,
+                        "height": image.height,
+                        "keeper": image is members[0],
+                    })
+            json.dump(
+                {members[0].file_path: [image.file_path for image in members[1:]] for members in clusters},
+                json_file,
+                indent=4,
+            )
+        console.log(
+            f"Found {len(clusters)} duplicate groups, {sum(len(members) - 1 for members in clusters)} "
+            f"images could go. Saved to: {self.group_log_file}"
         )
-        self.pickle_and_save(self.prelim_results, self.log_file, "wb", "json")
-        self.pickle_and_save(self.prelim_results, self.log_file, "wb", "csv")
 
-    def pickle_and_save(
-        self,
-        log_obj: dict,
-        log_file_path:str,
-        mode:   Literal["wb", "rb"] = "rb",
-        option: Literal["pickle", "csv", "json"] = "pickle"
-    ) -> None:
-        """Store temporary data in a pickle file."""
-        if option == "pickle":
-            with open(log_file_path, mode) as pickle_file:
-                if mode == "rb":
-                    return pickle.load(pickle_file)
-                else:
-                    pickle.dump(log_obj, pickle_file, pickle.HIGHEST_PROTOCOL)
-                    console.log(f"Saved pickle data to: {log_file_path}")
-        if option == "json":
-            """Save results into a CSV file."""
-            with open(f"{log_file_path}.json", "w") as json_file:
-                json.dump(log_obj, json_file, indent=4, sort_keys=True)
-        if option == "csv":
-            results_cols = [
-                "pic1", "pic2", "size_1", "size_2", "matches", "similarity"
-            ]
-            df = pd.DataFrame.from_dict(
-                log_obj, orient="index", columns=results_cols
-            ).sort_values(by=["similarity"], ascending=False)
-            df.to_csv(f"{log_file_path}.csv", index=False)
-            console.log(f"Saved comparison results to: {log_file_path}")
-    
     def create_subfolders(self, paths: dict):
         for _, path in paths.items():
             if not os.path.isdir(path):
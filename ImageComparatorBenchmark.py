@@ -0,0 +1,289 @@
+"""Benchmark ImageComparator on a synthetic corpus of known duplicates.
+
+A corpus of random textures is generated together with resized, cropped,
+recompressed and rotated copies of each, so the true duplicate pairs are
+known. Each phase of ImageComparator is then timed on the CPU
+(use_cuda=False) and the detected pairs are scored against the truth:
+precision and recall across a sweep of similarity thresholds, at the
+threshold with the best F1, and how far apart the similarities of true
+and unrelated pairs lie.
+
+USAGE EXAMPLES:
+$ python ImageComparatorBenchmark.py
+$ python ImageComparatorBenchmark.py --originals 200 --top-k 10 --json bench.json
+$ python ImageComparatorBenchmark.py --reduce 2 --max-features 1000 --quantize
+$ python ImageComparatorBenchmark.py --thresholds 0.1 0.2 0.3
+"""
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+import cv2
+
+from rich.console import Console
+from rich.table import Table
+
+from ImageComparator import ImageComparator, ExtractionProfile, RESULT_DTYPE, READ_WORKERS
+console = Console(log_time=True, log_path=False)
+
+VARIANTS = ("resized", "cropped", "recompressed", "rotated")
+
+
+def noise_layer(rng: np.random.Generator, size: int, cells: int) -> np.ndarray:
+    """Random colours on a cells x cells grid, smoothly upscaled to size x size."""
+    grid = rng.random((cells, cells, 3), dtype=np.float32)
+    return cv2.resize(grid, (size, size), interpolation=cv2.INTER_CUBIC)
+
+
+def random_texture(rng: np.random.Generator, size: int) -> np.ndarray:
+    """Noise at a few random scales with irregular polygons on top, each filled
+    with noise of its own.
+
+    Solid circles, boxes and lines drawn on every image give every image the
+    same corners, so unrelated images share many SIFT matches. Here the
+    scales, outlines and fills all differ per image.
+    """
+    img = np.zeros((size, size, 3), np.float32)
+    for cells in rng.choice([4, 8, 16, 32, 64], size=3, replace=False):
+        img += noise_layer(rng, size, int(cells)) * rng.uniform(0.3, 1.0)
+    img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    for _ in range(int(rng.integers(8, 20))):
+        center = rng.integers(0, size, 2)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, int(rng.integers(3, 9))))
+        radii = rng.integers(size // 16, size // 4) * rng.uniform(0.4, 1.0, len(angles))
+        polygon = np.stack(
+            [center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1
+        ).astype(np.int32)
+        mask = np.zeros((size, size), np.uint8)
+        cv2.fillPoly(mask, [polygon], 255)
+        fill = cv2.normalize(noise_layer(rng, size, int(rng.integers(6, 48))), None, 0, 255, cv2.NORM_MINMAX)
+        img[mask > 0] = fill.astype(np.uint8)[mask > 0]
+    return img
+
+
+def make_variant(img: np.ndarray, variant: str, rng: np.random.Generator) -> "tuple[np.ndarray, list]":
+    """Return a modified copy of img and its JPEG write parameters."""
+    height, width = img.shape[:2]
+    if variant == "resized":
+        scale = rng.uniform(0.4, 0.8)
+        return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), []
+    if variant == "cropped":
+        margin = rng.uniform(0.05, 0.15)
+        top, left = int(height * margin), int(width * margin)
+        return img[top:height - top, left:width - left], []
+    if variant == "recompressed":
+        return img, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(20, 50))]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-20, 20), 1.0)
+    return cv2.warpAffine(img, rotation, (width, height), borderMode=cv2.BORDER_REFLECT), []
+
+
+def build_corpus(folder_path: str, originals: int, variants: int, size: int, seed: int) -> "set[frozenset]":
+    """Write the corpus to folder_path/Images and return the true duplicate pairs."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(f"{folder_path}/Images", exist_ok=True)
+    duplicates: set[frozenset] = set()
+    for i in range(originals):
+        img = random_texture(rng, size)
+        group = [f"orig_{i:05d}.jpg"]
+        cv2.imwrite(f"{folder_path}/Images/{group[0]}", img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        for variant in rng.choice(VARIANTS, size=min(variants, len(VARIANTS)), replace=False):
+            copy, params = make_variant(img, str(variant), rng)
+            group.append(f"orig_{i:05d}_{variant}.jpg")
+            cv2.imwrite(f"{folder_path}/Images/{group[-1]}", copy, params or [cv2.IMWRITE_JPEG_QUALITY, 90])
+        duplicates.update(
+            frozenset((a, b)) for k, a in enumerate(group) for b in group[k + 1:]
+        )
+    return duplicates
+
+
+def peak_rss_mib() -> "dict[str, float] | None":
+    """Peak resident memory of this process and of its largest worker.
+
+    The OS only reports the peak of the single largest child, not of all
+    of them at once, so with N workers the whole run may have used up to
+    parent + N x largest_worker.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux reports KiB, macOS bytes.
+    unit = 1024 * 1024 if os.uname().sysname == "Darwin" else 1024
+    return {
+        "parent":         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        "largest_worker": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def at_threshold(pairs: "list[tuple[float, bool]]", true_pairs: int, threshold: float) -> "dict[str, float]":
+    """Precision and recall of the pairs at or above threshold."""
+    flagged = [is_true for similarity, is_true in pairs if similarity >= threshold]
+    true_positives = sum(flagged)
+    return {
+        "threshold": threshold,
+        "flagged":   len(flagged),
+        "precision": true_positives / len(flagged) if flagged else 0.0,
+        "recall":    true_positives / true_pairs if true_pairs else 0.0,
+    }
+
+
+def score(csv_path: str, duplicates: "set[frozenset]", thresholds: "list[float]") -> dict:
+    """Score the pairs in a results CSV against the true duplicates.
+
+    Returns precision and recall at each threshold, at the calibrated
+    threshold (the one with the best F1) and how the similarities of true
+    and unrelated pairs are spread.
+    """
+    pairs: list[tuple[float, bool]] = []
+    with open(csv_path, newline="") as csv_file:
+        for row in csv.DictReader(csv_file):
+            pair = frozenset((os.path.basename(row["pic1"]), os.path.basename(row["pic2"])))
+            pairs.append((float(row["similarity"]), pair in duplicates))
+    # Sorted by descending similarity, so every prefix is a threshold.
+    pairs.sort(key=lambda pair: -pair[0])
+    best_f1, calibrated, true_positives = -1.0, 1.0, 0
+    for flagged, (similarity, is_true) in enumerate(pairs, 1):
+        true_positives += is_true
+        f1 = 2 * true_positives / (flagged + len(duplicates))
+        if f1 > best_f1:
+            best_f1, calibrated = f1, similarity
+
+    def spread(similarities: "list[float]") -> "dict[str, float] | None":
+        if not similarities:
+            return None
+        return {
+            "min":    float(np.min(similarities)),
+            "median": float(np.median(similarities)),
+            "p99":    float(np.percentile(similarities, 99)),
+            "max":    float(np.max(similarities)),
+        }
+
+    return {
+        "sweep":      [at_threshold(pairs, len(duplicates), threshold) for threshold in thresholds],
+        "calibrated": {**at_threshold(pairs, len(duplicates), calibrated), "f1": max(best_f1, 0.0)},
+        "true_similarity":      spread([similarity for similarity, is_true in pairs if is_true]),
+        "unrelated_similarity": spread([similarity for similarity, is_true in pairs if not is_true]),
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    folder_path = args.folder or tempfile.mkdtemp(prefix="image_comparator_bench_")
+    # Start from an empty cache, or nothing would be read or compared.
+    shutil.rmtree(f"{folder_path}/meta", ignore_errors=True)
+    try:
+        start = time.perf_counter()
+        duplicates = build_corpus(folder_path, args.originals, args.variants, args.size, args.seed)
+        console.log(f"Generated corpus in {time.perf_counter() - start:.2f}s at {folder_path}")
+
+        profile = ExtractionProfile(
+            reduce=args.reduce, max_side=args.max_side,
+            max_features=args.max_features, quantize=args.quantize,
+        )
+        comparator = ImageComparator(folder_path, use_cuda=False, top_k=args.top_k, profile=profile)
+        timings: dict[str, dict[str, float]] = {}
+
+        def timed(phase: str, function: callable, *function_args) -> None:
+            wall, cpu = time.perf_counter(), time.process_time()
+            function(*function_args)
+            timings[phase] = {
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s":  time.process_time() - cpu,
+            }
+
+        def fetch_all() -> None:
+            comparator.files = {}
+            for image_folder in comparator.folders["images"]:
+                comparator.fetch_all_image_files(image_folder)
+
+        timed("fetch_all_image_files", fetch_all)
+        images = len(comparator.files)
+        timed("read_images", comparator.read_images, args.workers, args.read_workers)
+        timed("compare_images", comparator.compare_images)
+        timed("save_results", comparator.save_results, comparator.log_file)
+        # compare_images saves its results once as well.
+        for key in ("wall_s", "cpu_s"):
+            timings["compare_images"][key] -= timings["save_results"][key]
+
+        pairs = os.path.getsize(comparator.results.file_path) // RESULT_DTYPE.itemsize
+        report = {
+            "images":      images,
+            "pairs":       pairs,
+            "true_pairs":  len(duplicates),
+            "phases":      timings,
+            "images_per_s": images / timings["read_images"]["wall_s"],
+            "pairs_per_s":  pairs / max(timings["compare_images"]["wall_s"], 1e-9),
+            "peak_rss_mib": peak_rss_mib(),
+            **score(f"{comparator.log_file}.csv", duplicates, args.thresholds),
+        }
+    finally:
+        if not args.keep and not args.folder:
+            shutil.rmtree(folder_path, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict) -> None:
+    table = Table(title="ImageComparator benchmark")
+    table.add_column("Phase")
+    table.add_column("Wall (s)", justify="right")
+    table.add_column("CPU (s)", justify="right")
+    for phase, timing in report["phases"].items():
+        table.add_row(phase, f"{timing['wall_s']:.3f}", f"{timing['cpu_s']:.3f}")
+    console.print(table)
+    peak = report["peak_rss_mib"]
+    console.print(
+        f"{report['images']} images, {report['pairs']:,} pairs compared | "
+        f"{report['images_per_s']:.1f} images/s read | {report['pairs_per_s']:,.0f} pairs/s compared | "
+        + ("peak RSS n/a" if peak is None else
+           f"peak RSS {peak['parent']:,.0f} MiB parent, {peak['largest_worker']:,.0f} MiB largest worker")
+    )
+    sweep = Table(title=f"Detection of {report['true_pairs']} true duplicates")
+    for column in ("Threshold", "Flagged", "Precision", "Recall"):
+        sweep.add_column(column, justify="right")
+    calibrated = report["calibrated"]
+    for result in report["sweep"] + [calibrated]:
+        sweep.add_row(
+            f"{result['threshold']:.3f}" + (" (best F1)" if result is calibrated else ""),
+            str(result["flagged"]),
+            f"{result['precision']:.3f}",
+            f"{result['recall']:.3f}",
+        )
+    console.print(sweep)
+    for label, key in (("True pairs", "true_similarity"), ("Unrelated pairs", "unrelated_similarity")):
+        spread = report[key]
+        if spread is not None:
+            console.print(
+                f"{label}: similarity min {spread['min']:.3f} | median {spread['median']:.3f} | "
+                f"p99 {spread['p99']:.3f} | max {spread['max']:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--originals", type=int, default=50, help="Distinct synthetic images.")
+    parser.add_argument("--variants", type=int, default=3, help=f"Modified copies per image (max {len(VARIANTS)}).")
+    parser.add_argument("--size", type=int, default=640, help="Side of the generated images in pixels.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.05, 0.1, 0.15, 0.2, 0.3],
+                        help="Similarities at which precision and recall are reported.")
+    parser.add_argument("--top-k", type=int, default=0, help="ImageComparator top_k; 0 compares all pairs.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="SIFT extraction processes.")
+    parser.add_argument("--read-workers", type=int, default=READ_WORKERS, help="Threads prefetching image files.")
+    parser.add_argument("--reduce", type=int, default=1, choices=(1, 2, 4, 8))
+    parser.add_argument("--max-side", type=int, default=0)
+    parser.add_argument("--max-features", type=int, default=0)
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--folder", help="Build the corpus here (kept) instead of a temporary folder.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary corpus folder.")
+    parser.add_argument("--json", help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file, indent=4)
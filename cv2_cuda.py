@@ -1,4 +1,5 @@
 import time
+import numpy as np
 
 import cv2
 from cv2 import cuda, SIFT
@@ -39,9 +40,10 @@ for i in range(len(gpu_descriptions)):
     for j in range(i + 1, len(gpu_descriptions)):
         gpu_match = matcher.knnMatchAsync(gpu_descriptions[i], gpu_descriptions[j], k=2, stream=stream)
         stream.waitForCompletion()
-        matches = matcher.knnMatchConvert(gpu_match)
-        good_matches = [m for m, n in matches if m.distance < 0.7 * n.distance]
-        similarity = len(good_matches) / len(matches) if matches else 0
+        # Row 0 of the k=2 result holds train indices, row 1 the float32 distances.
+        distances = gpu_match.download()[1].view(np.float32)
+        good_matches = np.count_nonzero(distances[:, 0] < 0.7 * distances[:, 1])
+        similarity = good_matches / len(distances) if len(distances) else 0
         print(f"Match between {files[i]} and {files[j]}: {similarity:.6f}")
 
 print(f"Finished at matching images {time.time() - start:.2f} seconds.")
@@ -1,13 +1,24 @@
+import os
+import sys
+import json
 import time
+import zlib
+import random
+import shutil
+import hashlib
+import tempfile
 import aiohttp
 import asyncio
 import aiofiles
 
-from os import rename
+from os import remove, replace
 from os.path import exists, getsize
+from collections import Counter, deque
+from dataclasses import dataclass
+from urllib.parse import urlsplit
 
 from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn, TaskID
+from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn
 
 import warnings
 warnings.simplefilter("ignore")
@@ -17,73 +28,251 @@ MiB = KiB*KiB
 GiB = MiB*MiB
 TiB = GiB*GiB
 PiB = TiB*TiB
+# Open connections kept per host, reused across files.
+CONNECTIONS_PER_HOST = 8
+# Seconds a resolved host name is cached.
+DNS_CACHE_SECONDS = 300
+# Seconds an idle connection is kept open for the next file.
+KEEPALIVE_SECONDS = 30
+# Files at least this large are split into segments when segments > 1.
+SEGMENT_MIN_SIZE = 16*MiB
+# Saved next to each .PART file to resume it.
+JOURNAL_SUFFIX = ".PART.journal"
+# Bytes a download fetches between saves of its journal.
+JOURNAL_CHECKPOINT = 4*MiB
+# Bounds of the adaptive read size; reads are coalesced into CHUNK_MAX writes.
+CHUNK_MIN = 64*KiB
+CHUNK_MAX = 4*MiB
+# Seconds between redraws of the rich progress sinks.
+PROGRESS_INTERVAL = 0.25
+# Seconds before the first retry of a failed download; doubles every retry.
+RETRY_BACKOFF = 1.0
+# HTTP statuses worth retrying besides 5xx.
+RETRY_STATUSES = (408, 429)
 console = Console(record=False)
 
 
+class ResumeInvalidated(Exception):
+    """The file changed on the server since its .PART was started."""
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as local_file:
+        while data := local_file.read(CHUNK_MAX):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class DownloadCache:
+    """Content-addressed store of downloaded files.
+
+    objects/ab/abcd... holds every distinct content once, named by its
+    SHA-256, and urls.jsonl maps a URL and the version (ETag, else
+    Last-Modified) it served to that SHA-256. Cached content is hardlinked
+    into place, or copied if the cache is on another device.
+    """
+    def __init__(self, folder_path: str) -> None:
+        self.objects = f"{folder_path}/objects"
+        self.index_path = f"{folder_path}/urls.jsonl"
+        os.makedirs(self.objects, exist_ok=True)
+        self.urls: dict[tuple[str, str], str] = {}
+        # URLs with at least one cached version, to skip probing the rest.
+        self.cached_urls: set[str] = set()
+        if exists(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    self.urls[(entry["url"], entry["version"])] = entry["sha256"]
+                    self.cached_urls.add(entry["url"])
+
+    def lookup(self, url: str, version: "str | None") -> "str | None":
+        return self.urls.get((url, version)) if version else None
+
+    def object_path(self, sha256: str) -> str:
+        return f"{self.objects}/{sha256[:2]}/{sha256}"
+
+    def link(self, sha256: str, file_path: str) -> bool:
+        """Put the cached content with this SHA-256 at file_path, if there is any."""
+        source = self.object_path(sha256)
+        if not exists(source):
+            return False
+        self._link(source, file_path + ".CACHE")
+        replace(file_path + ".CACHE", file_path)
+        return True
+
+    def add(self, file_path: str, sha256: str, url: str, version: "str | None") -> None:
+        """Store a downloaded file, unless its content is cached already."""
+        target = self.object_path(sha256)
+        if not exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # A name of its own, as the same content may be added by two downloads at once.
+            handle, temporary = tempfile.mkstemp(suffix=".CACHE", dir=os.path.dirname(target))
+            os.close(handle)
+            self._link(file_path, temporary)
+            replace(temporary, target)
+        if version and self.urls.get((url, version)) != sha256:
+            self.urls[(url, version)] = sha256
+            self.cached_urls.add(url)
+            with open(self.index_path, "a") as index_file:
+                index_file.write(json.dumps({"url": url, "version": version, "sha256": sha256}) + "\n")
+
+    def _link(self, source: str, target: str) -> None:
+        if exists(target):
+            remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+
+class BandwidthLimiter:
+    """Shares a cap of rate bytes per second between every download.
+
+    Each read books the next free slot on a virtual clock and waits until
+    its slot starts. A rate of 0 is unlimited.
+    """
+    def __init__(self, rate: int = 0) -> None:
+        self.rate = rate
+        self.allowed_at = 0.0
+
+    async def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        now = time.monotonic()
+        start = max(self.allowed_at, now)
+        self.allowed_at = start + size / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+@dataclass
+class FileStats:
+    """Live counters of one file's download. Downloads only bump these; the
+    progress sinks read them on their own timer."""
+    name:       str
+    total:      "int | None" = None
+    completed:  int = 0
+    # Bytes fetched in this run, for the transfer rate.
+    downloaded: int = 0
+    # queued, downloading, retrying, done, cached or failed.
+    state:      str = "queued"
+    error:      str = ""
+    started:    float = 0.0
+    finished:   float = 0.0
+
+
 class FileDownloader:
-    def __init__(self, links:dict, concurrent_downloads:bool=True) -> None:
+    def __init__(
+        self,
+        links:dict,
+        concurrent_downloads:bool=True,
+        segments:int=1,
+        max_concurrent:int=3,
+        max_per_host:int=None,
+        smallest_first:bool=True,
+        bandwidth:int=0,
+        retries:int=3,
+        cache_folder:str=None,
+        progress:"str | ProgressSink"="rich",
+        run_now:bool=True,
+    ) -> None:
         """Download files from a dicitonary.
 
-        param links: The files to download.
+        By default the files are downloaded right away. To run the download
+        yourself, e.g. inside an event loop that is already running:
+
+        >>> downloader = FileDownloader(links, progress="jsonl", run_now=False)
+        >>> failed = await downloader.run()
+
+        Every download keeps a journal next to its .PART file (see
+        _new_journal), so an interrupted batch resumes each file from the
+        bytes it already has, as long as the file did not change.
+
+        param links: The files to download, as {name: [url, path, size, sha256]}.
+            The size and SHA-256 are optional. A file with a SHA-256 is
+            verified against it, and an existing file that doesn't match is
+            downloaded again.
         type  links: Dict
         param concurrent_downloads: Weather to download one by one or alltogether.
         type  concurrent_downloads: Bool.
+        param segments: Split files of at least SEGMENT_MIN_SIZE into this many
+            byte ranges downloaded in parallel, if the server accepts ranges.
+        type  segments: Integer
+        param max_concurrent: Files downloaded at once (1 if not concurrent_downloads).
+        type  max_concurrent: Integer
+        param max_per_host: Files downloaded at once from the same host.
+            None leaves only the max_concurrent cap.
+        type  max_per_host: Integer
+        param smallest_first: Start with the smallest files (of known size),
+            else go in the order of links.
+        type  smallest_first: Bool
+        param bandwidth: Bytes per second shared by all downloads, 0 for no cap.
+        type  bandwidth: Integer
+        param retries: Times a download is retried, with exponential backoff,
+            after a connection error, timeout, HTTP 408/429 or 5xx.
+        type  retries: Integer
+        param cache_folder: Keep a DownloadCache here. Files whose URL and
+            version, or SHA-256, are cached are linked instead of downloaded.
+        type  cache_folder: String
+        param progress: How progress is shown: "rich" (a bar per file),
+            "summary" (one bar for everything), "jsonl" (a line of totals on
+            stdout every 10 seconds), "none", or a ProgressSink.
+        type  progress: String or ProgressSink
+        param run_now: Download while constructing. If False, call run().
+        type  run_now: Bool
         :rtype: Dict
         """
-        self.description :str = "[yellow][b]Downloading {0} | {1}[/b] | {2}"
-        download_links = {}
+        self.sink = PROGRESS_SINKS[progress]() if isinstance(progress, str) else progress
+        self.concurrent_downloads = concurrent_downloads
+        self.segments = segments
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        self.smallest_first = smallest_first
+        self.limiter = BandwidthLimiter(bandwidth)
+        self.retries = retries
+        self.cache = None if cache_folder is None else DownloadCache(cache_folder)
+        # File name -> the error its download gave up on.
+        self.failed: dict[str, Exception] = {}
+        # File path -> the SHA-256 it must have.
+        self.checksums: dict[str, str] = {}
+        # File path -> the size given for it in links.
+        self.sizes: dict[str, int] = {}
+        # File name -> [url, path, size] of the files still to download.
+        self.links: dict[str, list] = {}
         # Get a proper dictionary of files to download.
         for file_name, file_info in links.items():
-            # Make sure file there is a file size to check.
-            if len(file_info) < 3: file_info.append(28)
-            file_url, file_path, file_size = file_info
-            # If file already exists, skip it.
-            if exists(file_path) and getsize(file_path) == file_size:
+            file_url, file_path, file_size, sha256 = (list(file_info) + [None, None])[:4]
+            if sha256:
+                self.checksums[file_path] = sha256.lower()
+            if file_size is not None:
+                self.sizes[file_path] = file_size
+            # The final file only appears once a download is complete.
+            if exists(file_path) and file_size in (None, getsize(file_path)) and (
+                not sha256 or file_sha256(file_path) == sha256.lower()
+            ):
                 continue
-            # If file was partially downloaded, start with the part file.
-            elif exists(file_path + ".PART"):
-                part_file = getsize(file_path + ".PART")
-                download_links.update(
-                    {
-                        file_name:[
-                            file_url,
-                            file_path,
-                            file_size,
-                            "ab",
-                            {'Range': f"bytes=-{file_size - part_file}"}
-                        ]
-                    }
-                )
-            # If file didn't exist before.
-            else:
-                download_links.update(
-                    {
-                        file_name:[
-                            file_url,
-                            file_path,
-                            file_size,
-                            "wb",
-                            {}
-                        ]
-                    }
-                )
-
-        # Set up the progress bar.    
-        with Progress(
-            SpinnerColumn(),
-            *Progress.get_default_columns(),
-            TimeElapsedColumn(),
-            console=console,
-        ) as progress:
-            for file_name, file_info in download_links.items():
-                file_info.append(progress.add_task(f"[blue]Queued [b]{file_name}[/b]", total=file_info[2]))
+            self.links[file_name] = [file_url, file_path, file_size]
+        self.stats = {file_name: FileStats(file_name, file_info[2]) for file_name, file_info in self.links.items()}
+
+        if run_now:
+            asyncio.run(self.run())
 
-            if concurrent_downloads:
-                asyncio.run(self.download_concurrently(progress, download_links))
-            else:
-                self.download_individually(progress, download_links)
+    async def run(self) -> "dict[str, Exception]":
+        """Download every file and return the ones that failed, by name."""
+        stats = list(self.stats.values())
+        self.sink.open(stats)
+        renderer = asyncio.create_task(self.sink.run(stats))
+        try:
+            await self._schedule(self.max_concurrent if self.concurrent_downloads else 1)
+        finally:
+            renderer.cancel()
+            await asyncio.gather(renderer, return_exceptions=True)
+            self.sink.close(stats)
+        return self.failed
 
-    def _size_notation(self, n:int, np:int = 2) -> str:
+    @staticmethod
+    def _size_notation(n:int, np:int = 2) -> str:
         """Return a string showing a number in B/KiB/MiB/GiB format.
         
         Raises ValueError if "n" not in [0, 1PiB).
@@ -108,82 +297,583 @@ class FileDownloader:
             return f"{n/TiB:.{np}f} TB"
         raise ValueError(f"File too large, >= 1 Petabyte ({PiB}).")
 
+    def _create_session(self) -> aiohttp.ClientSession:
+        """Return the session every download shares, so files from the same
+        host reuse its DNS lookup and open (TLS) connections.
+
+        Must be called with an event loop running.
+        """
+        connector = aiohttp.TCPConnector(
+            limit_per_host    = CONNECTIONS_PER_HOST,
+            ttl_dns_cache     = DNS_CACHE_SECONDS,
+            keepalive_timeout = KEEPALIVE_SECONDS,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=3000))
+
+    async def _schedule(self, workers: int) -> None:
+        """Download self.links with a pool of workers over a priority queue.
+
+        A file whose host already has max_per_host downloads running is set
+        aside and queued again when one of them finishes, so it never holds
+        up a worker.
+        """
+        queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        for order, (file_name, file_info) in enumerate(self.links.items()):
+            size = file_info[2]
+            priority = (size is None, size or 0) if self.smallest_first else ()
+            queue.put_nowait((priority, order, file_name))
+        active: dict[str, int] = {}
+        waiting: dict[str, deque] = {}
+
+        async with self._create_session() as session:
+            async def worker() -> None:
+                while True:
+                    item = await queue.get()
+                    file_name = item[2]
+                    host = urlsplit(self.links[file_name][0]).hostname
+                    try:
+                        if self.max_per_host and active.get(host, 0) >= self.max_per_host:
+                            waiting.setdefault(host, deque()).append(item)
+                            continue
+                        active[host] = active.get(host, 0) + 1
+                        try:
+                            await self._download_with_retries(session, file_name)
+                        except Exception as error:
+                            # A worker must never die with files left in the queue.
+                            self._record_failure(file_name, error)
+                        finally:
+                            active[host] -= 1
+                            if waiting.get(host):
+                                queue.put_nowait(waiting[host].popleft())
+                    finally:
+                        queue.task_done()
+
+            tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+            await queue.join()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _is_transient(self, error: Exception) -> bool:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500 or error.status in RETRY_STATUSES
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+    def _record_failure(self, file_name: str, error: Exception) -> None:
+        stats = self.stats[file_name]
+        self.failed[file_name] = error
+        stats.error, stats.state, stats.finished = repr(error), "failed", time.perf_counter()
+
+    async def _download_with_retries(self, session: aiohttp.ClientSession, file_name: str) -> None:
+        """Download a file, retrying transient errors from where it got to.
+        A file that still fails is recorded in self.failed."""
+        url, file_path, _ = self.links[file_name]
+        stats = self.stats[file_name]
+        stats.state, stats.started = "downloading", time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                if await self._link_from_cache(session, url, file_path, stats):
+                    stats.state = "cached"
+                else:
+                    # After the first attempt, everything journaled was
+                    # flushed by this process, so needs no check.
+                    journal = await asyncio.to_thread(self._load_journal, file_path, attempt == 0)
+                    await self._download(session, url, file_path, journal, stats)
+                    stats.state = "done"
+                stats.finished = time.perf_counter()
+                return
+            except Exception as error:
+                if attempt == self.retries or not self._is_transient(error):
+                    self._record_failure(file_name, error)
+                    return
+                stats.error, stats.state = repr(error), "retrying"
+                await asyncio.sleep(RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+                stats.state = "downloading"
+
+    async def _link_from_cache(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        file_path: str,
+        stats: FileStats,
+    ) -> bool:
+        """Link a file from the cache if its SHA-256, or its URL at the version
+        the server has now, is in there."""
+        if self.cache is None:
+            return False
+        sha256 = self.checksums.get(file_path)
+        if sha256 is None:
+            if url not in self.cache.cached_urls:
+                return False
+            head = await self._probe(session, url)
+            sha256 = self.cache.lookup(url, head["etag"] or head["last_modified"])
+        if sha256 is None or not await asyncio.to_thread(self.cache.link, sha256, file_path):
+            return False
+        self._discard(file_path)
+        stats.total = stats.completed = getsize(file_path)
+        return True
+
+    async def _download(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        file_path: str,
+        journal: "dict | None",
+        stats: FileStats,
+    ) -> None:
+        """Download a file, resuming from its journal if it has one.
+
+        If the file changed on the server since, the .PART is discarded and
+        the file downloaded again from the start.
+        """
+        try:
+            await self._fetch(session, url, file_path, journal, stats)
+        except ResumeInvalidated:
+            self._discard(file_path)
+            await self._fetch(session, url, file_path, None, stats)
+
+    async def _fetch(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        file_path: str,
+        journal: "dict | None",
+        stats: FileStats,
+    ) -> None:
+        """Download in segments if the file is large enough (or was started in
+        segments) and its server accepts ranges, else as a single stream.
+
+        A file whose size in links is below SEGMENT_MIN_SIZE is streamed
+        without probing its server first.
+        """
+        segmented = journal is not None and len(journal["segments"]) > 1
+        small = self.sizes.get(file_path, SEGMENT_MIN_SIZE) < SEGMENT_MIN_SIZE
+        if (self.segments > 1 and not small) or segmented:
+            head = await self._probe(session, url)
+            if journal is not None and not self._same_version(journal, head):
+                raise ResumeInvalidated(url)
+            if head["accepts_ranges"] and (head["length"] >= SEGMENT_MIN_SIZE or segmented):
+                return await self._segmented_downloader(session, url, file_path, head, journal, stats)
+            if segmented:
+                raise ResumeInvalidated(url)
+        await self._file_downloader(session, url, file_path, journal, stats)
+
+    async def _probe(self, session: aiohttp.ClientSession, url: str) -> dict:
+        """Return the length, validators and range support of a file."""
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status >= 400:
+                return {"length": 0, "accepts_ranges": False, "etag": None, "last_modified": None}
+            return {
+                "length":         response.content_length or 0,
+                "accepts_ranges": response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                                  and bool(response.content_length),
+                **self._validators(response),
+            }
+
+    def _validators(self, response: aiohttp.ClientResponse) -> dict:
+        return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+    def _same_version(self, journal: dict, head: dict) -> bool:
+        """Whether a HEAD response describes the file a journal was started on."""
+        if journal["length"] is not None and head["length"] and head["length"] != journal["length"]:
+            return False
+        return all(
+            journal[key] == head[key] for key in ("etag", "last_modified") if journal[key] and head[key]
+        )
+
+    def _if_range(self, journal: dict) -> dict:
+        """Headers that make a range request fall back to the whole file (HTTP
+        200) if the file changed since the journal was started. Weak ETags
+        can't be used for this."""
+        etag = journal["etag"]
+        if etag and not etag.startswith("W/"):
+            return {"If-Range": etag}
+        if journal["last_modified"]:
+            return {"If-Range": journal["last_modified"]}
+        return {}
+
+    def _new_journal(self, url: str, length: "int | None", validators: dict, segments: "list[list[int]]") -> dict:
+        """Return the journal of a download.
+
+        length is None if the server did not send one. Each segment is
+        [start, end, position, crc32]: bytes start to position of the .PART
+        are saved and their CRC-32 is crc32. end is None for a stream of
+        unknown length.
+        """
+        return {"url": url, "length": length, **validators, "segments": segments}
+
+    def _load_journal(self, file_path: str, verify: bool = True) -> "dict | None":
+        """Return the journal of an interrupted download, with every segment
+        rewound to its start if its saved bytes no longer match their CRC-32
+        (unless verify is False).
+
+        A .PART without a readable journal (or a journal without validators
+        to check the file against) is discarded, as it can't be safely resumed.
+        """
+        part_path, journal_path = file_path + ".PART", file_path + JOURNAL_SUFFIX
+        if not (exists(part_path) and exists(journal_path)):
+            self._discard(file_path)
+            return None
+        try:
+            with open(journal_path) as journal_file:
+                journal = json.load(journal_file)
+            resumable = bool(self._if_range(journal)) and all(
+                len(segment) == 4 for segment in journal["segments"]
+            ) and "url" in journal and "length" in journal
+        except (OSError, ValueError, KeyError, TypeError):
+            resumable = False
+        if not resumable:
+            self._discard(file_path)
+            return None
+        if not verify:
+            return journal
+        part_size = getsize(part_path)
+        with open(part_path, "rb") as part_file:
+            for segment in journal["segments"]:
+                start, _, position, saved_crc = segment
+                crc = 0
+                if position <= part_size:
+                    part_file.seek(start)
+                    remaining = position - start
+                    while remaining:
+                        data = part_file.read(min(remaining, JOURNAL_CHECKPOINT))
+                        crc = zlib.crc32(data, crc)
+                        remaining -= len(data)
+                if position > part_size or crc != saved_crc:
+                    segment[2:] = [start, 0]
+        return journal
+
+    def _save_journal(self, file_path: str, journal: dict) -> None:
+        """Replace the journal atomically, so a crash never leaves half of one."""
+        journal_path = file_path + JOURNAL_SUFFIX
+        with open(journal_path + ".TMP", "w") as journal_file:
+            json.dump(journal, journal_file)
+        replace(journal_path + ".TMP", journal_path)
+
+    def _discard(self, file_path: str) -> None:
+        for suffix in (".PART", JOURNAL_SUFFIX, JOURNAL_SUFFIX + ".TMP"):
+            if exists(file_path + suffix):
+                remove(file_path + suffix)
+
+    async def _finish(self, file_path: str, journal: dict, digest: "hashlib._Hash | None" = None) -> None:
+        """Verify a completed .PART, move it into place and cache it.
+
+        digest is the SHA-256 computed while downloading, if the whole file
+        was streamed in order; otherwise the file is hashed here.
+        """
+        part_path = file_path + ".PART"
+        sha256 = None
+        if self.cache is not None or file_path in self.checksums:
+            sha256 = digest.hexdigest() if digest is not None else await asyncio.to_thread(file_sha256, part_path)
+            expected = self.checksums.get(file_path)
+            if expected and sha256 != expected:
+                self._discard(file_path)
+                raise ValueError(f"SHA-256 of {file_path} is {sha256}, not {expected}.")
+        remove(file_path + JOURNAL_SUFFIX)
+        # Clear the part file after completion.
+        replace(part_path, file_path)
+        if self.cache is not None:
+            await asyncio.to_thread(
+                self.cache.add, file_path, sha256, journal["url"], journal["etag"] or journal["last_modified"]
+            )
+
+    async def _write_segment(
+        self,
+        response: aiohttp.ClientResponse,
+        file_path: str,
+        journal: dict,
+        segment: "list[int]",
+        stats: FileStats,
+        digest: "hashlib._Hash | None" = None,
+    ) -> None:
+        """Write a response into the .PART at the segment's position, saving
+        the journal every JOURNAL_CHECKPOINT bytes.
+
+        Reads grow from CHUNK_MIN towards CHUNK_MAX while the connection keeps
+        them full and shrink when it doesn't. They are coalesced in memory and
+        written CHUNK_MAX at a time.
+        """
+        position, crc = segment[2], segment[3]
+        chunk_size = CHUNK_MIN
+        buffer = bytearray()
+        async with aiofiles.open(file_path + ".PART", "r+b") as local_file:
+            await local_file.seek(position)
+            while True:
+                data = await response.content.read(chunk_size)
+                if data:
+                    await self.limiter.consume(len(data))
+                    buffer += data
+                    crc = zlib.crc32(data, crc)
+                    if digest is not None:
+                        digest.update(data)
+                    stats.completed += len(data)
+                    stats.downloaded += len(data)
+                    if len(data) == chunk_size:
+                        chunk_size = min(chunk_size * 2, CHUNK_MAX)
+                    elif len(data) < chunk_size // 4:
+                        chunk_size = max(chunk_size // 2, CHUNK_MIN)
+                if len(buffer) >= CHUNK_MAX or (buffer and not data):
+                    await local_file.write(buffer)
+                    position += len(buffer)
+                    buffer.clear()
+                    if position - segment[2] >= JOURNAL_CHECKPOINT:
+                        # Only bytes that reached the file are journaled.
+                        await local_file.flush()
+                        segment[2:] = [position, crc]
+                        self._save_journal(file_path, journal)
+                if not data:
+                    break
+        segment[2:] = [position, crc]
+        self._save_journal(file_path, journal)
+
+    async def _segmented_downloader(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        file_path: str,
+        head: dict,
+        journal: "dict | None",
+        stats: FileStats,
+    ) -> None:
+        """Download the byte ranges of a file in parallel into a preallocated .PART.
+
+        Only the unfinished part of each segment is fetched. A stream that was
+        interrupted becomes a finished first segment.
+        """
+        length = head["length"]
+        if journal is None or len(journal["segments"]) == 1:
+            # [position, crc32] of an interrupted stream.
+            kept = journal["segments"][0][2:] if journal is not None else [0, 0]
+            if kept[0] >= length:
+                # Interrupted between the last write and the rename.
+                return await self._finish(file_path, journal)
+            source = journal if journal is not None else head
+            validators = {key: source[key] for key in ("etag", "last_modified")}
+            size = -(-(length - kept[0]) // self.segments)
+            segments = [[0, kept[0], *kept]] if kept[0] else []
+            segments += [[first, min(first + size, length), first, 0] for first in range(kept[0], length, size)]
+            journal = self._new_journal(url, length, validators, segments)
+            # Preallocate, so every segment can write at its own offset.
+            with open(file_path + ".PART", "r+b" if kept[0] else "wb") as part_file:
+                part_file.truncate(length)
+            self._save_journal(file_path, journal)
+        segments = journal["segments"]
+        stats.total = length
+        stats.completed = sum(position - first for first, _, position, _ in segments)
+
+        async def segment_downloader(segment: "list[int]") -> None:
+            position, end = segment[2], segment[1]
+            if position >= end:
+                return
+            headers = {"Range": f"bytes={position}-{end - 1}", **self._if_range(journal)}
+            async with session.get(url, headers=headers) as response:
+                if response.status == 200:
+                    raise ResumeInvalidated(url)
+                response.raise_for_status()
+                await self._write_segment(response, file_path, journal, segment, stats)
+
+        tasks = [asyncio.ensure_future(segment_downloader(segment)) for segment in segments]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other segments before the download is retried.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        await self._finish(file_path, journal)
+
     async def _file_downloader(
         self, 
+        session: aiohttp.ClientSession,
         url:str,
         file_path: str,
-        binary_mode: str,
-        task_id: TaskID,
-        progress: Progress,
-        semaphore = asyncio.Semaphore(3),
-        header: dict={},
+        journal: "dict | None",
+        stats: FileStats,
     ) -> None:
-        start = time.perf_counter()
-        download = 0
-        timeout = aiohttp.ClientTimeout(total=3000)
-        async with aiohttp.ClientSession(timeout=timeout) as session, semaphore:
-            async with session.get(url, headers=header) as response, aiofiles.open(file_path + ".PART", binary_mode) as local_file:
-                file_size = response.content_length
-                if binary_mode == "ab":
-                    file_size += getsize(file_path + ".PART")
-
-                progress.update(
-                    task_id,
-                    total   = file_size,
-                    advance = getsize(file_path + ".PART"),
-                )
-                async for data in response.content.iter_chunked(KiB):
-                    await local_file.write(data)
-                    download += len(data)
-                    bit_rate = f"{((download//(time.perf_counter() - start)) / MiB):.2f} Mb/s"
-                    progress.update(
-                        task_id,
-                        advance=len(data),
-                        description = self.description.format(
-                            self._size_notation(response.content_length),
-                            file_path[file_path.rfind('/')+1:],
-                            bit_rate
-                        )
-                    )
-        progress.update(
-            task_id,
-            description = "[green][b]Done {0} | {1}[/b] | {2}".format(
-                self._size_notation(response.content_length),
-                file_path[file_path.rfind('/')+1:],
-                bit_rate
-            )
-        )
-        # Clear the part file after completion.
-        rename(file_path + ".PART", file_path)
+        """Download a file as a single stream, continuing after the saved bytes
+        of its journal if the server still has the same file."""
+        if journal is not None and journal["length"] is not None and journal["segments"][0][2] >= journal["length"]:
+            # Interrupted between the last write and the rename.
+            return await self._finish(file_path, journal)
+        header = {}
+        if journal is not None and journal["segments"][0][2]:
+            header = {"Range": f"bytes={journal['segments'][0][2]}-", **self._if_range(journal)}
+        async with session.get(url, headers=header) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                # A new download, or the file changed and is sent whole.
+                length = response.content_length
+                journal = self._new_journal(url, length, self._validators(response), [[0, length, 0, 0]])
+            segment = journal["segments"][0]
+            # Drop any bytes past the journaled ones.
+            with open(file_path + ".PART", "r+b" if segment[2] else "wb") as part_file:
+                part_file.truncate(segment[2])
+            stats.total = journal["length"]
+            stats.completed = segment[2]
+            # Hash while downloading, unless part of the file came from earlier.
+            digest = hashlib.sha256() if segment[2] == 0 else None
+            self._save_journal(file_path, journal)
+            await self._write_segment(response, file_path, journal, segment, stats, digest)
+        stats.total = segment[2]
+        await self._finish(file_path, journal, digest)
 
-    def download_individually(self, progress: Progress, links:dict) -> None:
+    def download_individually(self) -> "dict[str, Exception]":
         """Downloading files one by one"""
-        for _, file_info in links.items():
-            asyncio.run(self._file_downloader(
-                progress    = progress,
-                url         = file_info[0],
-                file_path   = file_info[1],
-                binary_mode = file_info[3],
-                header      = file_info[4],
-                task_id     = file_info[5],
-            ))
-
-    async def download_concurrently(self, progress: Progress, links:dict) -> None:
-        """Download as many files as you set your semaphore to be"""
-        await asyncio.gather(
-            *(
-                self._file_downloader(
-                    progress    = progress,
-                    url         = file_info[0],
-                    file_path   = file_info[1],
-                    binary_mode = file_info[3],
-                    header      = file_info[4],
-                    task_id     = file_info[5],
-                ) for _, file_info in links.items()
+        self.concurrent_downloads = False
+        return asyncio.run(self.run())
+
+    async def download_concurrently(self) -> "dict[str, Exception]":
+        """Download up to max_concurrent files at once"""
+        self.concurrent_downloads = True
+        return await self.run()
+
+
+class ProgressSink:
+    """Shows the progress of a FileDownloader run; this one shows nothing.
+
+    Subclasses redraw from the FileStats of the run every interval seconds,
+    on their own timer, so the downloads themselves only bump counters.
+    """
+    interval = PROGRESS_INTERVAL
+
+    def open(self, stats: "list[FileStats]") -> None:
+        pass
+
+    def render(self, stats: "list[FileStats]") -> None:
+        pass
+
+    def close(self, stats: "list[FileStats]") -> None:
+        pass
+
+    async def run(self, stats: "list[FileStats]") -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.render(stats)
+
+
+class RichProgressSink(ProgressSink):
+    """A rich progress bar per file."""
+    description :str = "[yellow][b]Downloading {0} | {1}[/b] | {2}"
+
+    def open(self, stats: "list[FileStats]") -> None:
+        self.progress = Progress(
+            SpinnerColumn(),
+            *Progress.get_default_columns(),
+            TimeElapsedColumn(),
+            console=console,
+        )
+        self.tasks = [
+            self.progress.add_task(f"[blue]Queued [b]{file.name}[/b]", total=file.total) for file in stats
+        ]
+        # What each bar shows, so unchanged bars are skipped.
+        self.shown = [None] * len(stats)
+        self.progress.start()
+
+    def render(self, stats: "list[FileStats]") -> None:
+        now = time.perf_counter()
+        for i, file in enumerate(stats):
+            shown = (file.state, file.total, file.completed)
+            if file.state == "queued" or shown == self.shown[i]:
+                continue
+            self.shown[i] = shown
+            self.progress.update(
+                self.tasks[i],
+                total       = file.total,
+                completed   = file.completed,
+                description = self._describe(file, now),
             )
+
+    def _describe(self, file: FileStats, now: float) -> str:
+        size = FileDownloader._size_notation(file.total or file.completed)
+        bit_rate = f"{file.downloaded / max((file.finished or now) - file.started, 1e-9) / MiB:.2f} Mb/s"
+        if file.state == "done":
+            return f"[green][b]Done {size} | {file.name}[/b] | {bit_rate}"
+        if file.state == "cached":
+            return f"[green][b]Cached {size} | {file.name}"
+        if file.state == "failed":
+            return f"[red][b]Failed {file.name}[/b] | {file.error}"
+        if file.state == "retrying":
+            return f"[yellow]Retrying [b]{file.name}[/b] | {file.error}"
+        return self.description.format(size, file.name, bit_rate)
+
+    def close(self, stats: "list[FileStats]") -> None:
+        self.render(stats)
+        self.progress.stop()
+        for file in stats:
+            if file.state == "failed":
+                console.print(f"[red]Failed to download [b]{file.name}[/b]: {file.error}")
+
+
+class SummaryProgressSink(RichProgressSink):
+    """A single rich progress bar for the bytes of every file."""
+    def open(self, stats: "list[FileStats]") -> None:
+        self.progress = Progress(
+            SpinnerColumn(),
+            *Progress.get_default_columns(),
+            TimeElapsedColumn(),
+            console=console,
+        )
+        self.task = self.progress.add_task(f"[blue]Queued [b]{len(stats)} files[/b]", total=None)
+        self.start = time.perf_counter()
+        self.progress.start()
+
+    def render(self, stats: "list[FileStats]") -> None:
+        states = Counter(file.state for file in stats)
+        downloaded = sum(file.downloaded for file in stats)
+        bit_rate = f"{downloaded / max(time.perf_counter() - self.start, 1e-9) / MiB:.2f} Mb/s"
+        self.progress.update(
+            self.task,
+            # Sizes become known as their downloads start.
+            total       = sum(file.total or 0 for file in stats) or None,
+            completed   = sum(file.completed for file in stats),
+            description = (
+                f"[yellow][b]{states['done'] + states['cached']}/{len(stats)} files[/b] | "
+                f"{states['downloading'] + states['retrying']} active | {states['failed']} failed | {bit_rate}"
+            ),
         )
 
 
+class JsonLinesProgressSink(ProgressSink):
+    """Writes a JSON line of totals every interval seconds, and a last one
+    with the errors of the failed files."""
+    def __init__(self, file_path: str = None, interval: float = 10.0) -> None:
+        """file_path: Append the lines to this file instead of stdout."""
+        self.file_path = file_path
+        self.interval = interval
+
+    def open(self, stats: "list[FileStats]") -> None:
+        self.file = sys.stdout if self.file_path is None else open(self.file_path, "a", buffering=1)
+        self.start = time.perf_counter()
+
+    def render(self, stats: "list[FileStats]", **extra) -> None:
+        elapsed = time.perf_counter() - self.start
+        downloaded = sum(file.downloaded for file in stats)
+        self.file.write(json.dumps({
+            "time":        time.time(),
+            "elapsed_s":   elapsed,
+            "files":       len(stats),
+            **Counter(file.state for file in stats),
+            "bytes":       sum(file.completed for file in stats),
+            "total_bytes": sum(file.total or 0 for file in stats),
+            "mb_per_s":    downloaded / max(elapsed, 1e-9) / MiB,
+            **extra,
+        }) + "\n")
+
+    def close(self, stats: "list[FileStats]") -> None:
+        self.render(stats, errors={file.name: file.error for file in stats if file.state == "failed"})
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+PROGRESS_SINKS = {
+    "rich":    RichProgressSink,
+    "summary": SummaryProgressSink,
+    "jsonl":   JsonLinesProgressSink,
+    "none":    ProgressSink,
+}
+
+
 linky = {
     "totes_not_a_virus.nickelback.mp3.exe": [
         "https://www.thisisamericanwebsite.ru",
@@ -192,4 +882,5 @@ linky = {
     ]
 }
 
-FileDownloader(linky)
+if __name__ == "__main__":
+    FileDownloader(linky)
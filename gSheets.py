@@ -47,11 +47,25 @@ gs(CREDS_FILE).write_to_gsheet(
     sheet_range=sheet_range,
     value_input_option = 'USER_ENTERED',
     insert_data_option='INSERT_ROWS') ## WILL APPEND FROM LAST ROW
+
+# Run this to read or write many ranges, across sheets, in as few requests as possible.
+x = gs(CREDS_FILE).batch_get(SHEET_LINK, ["Sheet1!A1:C10", "TESTER!J1"])
+for value_range in x['valueRanges']:
+    print(value_range['range'], value_range.get('values'))
+
+gs(CREDS_FILE).batch_write(
+    SHEET_LINK,
+    {"Sheet1!A1": data_frame, "TESTER!J1": [[current_date]]},
+    value_input_option = 'USER_ENTERED',
+    clear = True) ## CLEARS THE RANGES FIRST, THEN WRITES THEM ALL
 """
 import json
+import httplib2
+import threading
 import pandas as pd
 
-from urllib.parse import urlparse
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, quote
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from oauth2client.service_account import ServiceAccountCredentials
@@ -64,17 +78,54 @@ class GoogleSheetsConnector:
         'https://spreadsheets.google.com/feeds',
         'https://www.googleapis.com/auth/drive'
         ] # we can pull from spreadsheet feeds and/or the google drive.
+    # batchGet sends its ranges in the URL; keep the query under this many characters.
+    BATCH_GET_URL_LIMIT = 8000
+    # batchUpdate/batchClear bodies are kept under this many bytes of JSON.
+    BATCH_PAYLOAD_LIMIT = 2 * 1024 * 1024
+    # Refresh an access token when it has less than this left.
+    TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+    # Shared by every connector in the process.
+    _subjects: dict = {}     # cred_path -> subject
+    _credentials: dict = {}  # (cred_path, subject) -> delegated credentials
+    _lock = threading.Lock()
+    # httplib2 isn't thread safe, so every thread gets its own services.
+    _local = threading.local()
 
     def __init__(self, cred_path):
         self.cred_path      = cred_path
-        self.imposter_email = json.load(open(cred_path))["subject"]
+        with self._lock:
+            if cred_path not in self._subjects:
+                with open(cred_path) as cred_file:
+                    self._subjects[cred_path] = json.load(cred_file)["subject"]
+        self.imposter_email = self._subjects[cred_path]
        
     def _create_connection_and_impersonate(self) -> object:
-        auth =  ServiceAccountCredentials.from_json_keyfile_name(self.cred_path, self.SCOPE)
-        credentials = auth.create_delegated(self.imposter_email)
-        # Needs to be v4 to be API version 4 
-        service = build('sheets', 'v4', credentials=credentials) 
-        return service 
+        """Return the Sheets service for this keyfile and subject.
+
+        The delegated credentials are made once per (cred_path, subject) and
+        refreshed shortly before their token expires. The service is built
+        once per thread, from the discovery document that ships with
+        googleapiclient, so it needs no network call.
+        """
+        key = (self.cred_path, self.imposter_email)
+        with self._lock:
+            credentials = self._credentials.get(key)
+            if credentials is None:
+                auth = ServiceAccountCredentials.from_json_keyfile_name(self.cred_path, self.SCOPE)
+                credentials = self._credentials[key] = auth.create_delegated(self.imposter_email)
+            # token_expiry is naive UTC.
+            expiry = credentials.token_expiry
+            if credentials.access_token is None or expiry is None or \
+                    expiry - datetime.utcnow() < self.TOKEN_REFRESH_MARGIN:
+                credentials.refresh(httplib2.Http())
+        services = self._local.__dict__.setdefault("services", {})
+        if key not in services:
+            # Needs to be v4 to be API version 4 
+            services[key] = build(
+                'sheets', 'v4', credentials=credentials, cache_discovery=False, static_discovery=True
+            )
+        return services[key]
     
     def get_from_gsheet(self, sheet_link:str, **kwargs) -> dict:
         """Pull directly from a specific Google Sheet.
@@ -89,6 +140,7 @@ class GoogleSheetsConnector:
         The caller must specify the spreadsheet ID and a range.
         BATCH_GET | Returns one or more ranges of values from a spreadsheet.
         The caller must specify the spreadsheet ID and one or more ranges.
+        sheet_range may then be a list of ranges, see batch_get.
         type get_option: string
         param major_dimension: DEFAULT:=ROWS | Operates on the rows of a sheet.
         COLUMNS | Operates on the columns of a sheet.
@@ -135,6 +187,11 @@ class GoogleSheetsConnector:
         if kwargs:
             params.update({i:kwargs[i] for i in kwargs.keys()})
 
+        if params.get("get_option") == "BATCH_GET":
+            ranges = params.pop("sheet_range")
+            params.pop("get_option")
+            return self.batch_get(sheet_link, [ranges] if isinstance(ranges, str) else ranges, **params)
+
         # Results will be in json format.
         results = self.service.spreadsheets().values().get(
                         spreadsheetId        = sheetId,
@@ -192,10 +249,7 @@ class GoogleSheetsConnector:
         if kwargs:
             params.update({i:kwargs[i] for i in kwargs.keys()})
 
-        if isinstance(table_data, pd.DataFrame):
-            data = pd.read_json(table_data.to_json()).to_numpy(na_value=None).tolist()
-        else:
-            data = table_data
+        data = self._table_values(table_data)
 
         ## OVERWRITE:
         if params["insert_data_option"] == 'OVERWRITE':
@@ -232,6 +286,147 @@ class GoogleSheetsConnector:
 
         return request
 
+    @staticmethod
+    def _table_values(table_data, header:bool = False) -> list:
+        """The rows of table_data as a list of lists, with the
+        column names first if header and table_data is a DataFrame."""
+        if not isinstance(table_data, pd.DataFrame):
+            return table_data
+        data = pd.read_json(table_data.to_json()).to_numpy(na_value=None).tolist()
+        return [list(table_data.columns)] + data if header else data
+
+    @staticmethod
+    def _chunks(items:list, size, limit:int) -> list:
+        """Split items into consecutive lists whose size(item) sum stays
+        within limit. An item bigger than limit gets a list of its own."""
+        chunks, chunk, total = [], [], 0
+        for item in items:
+            item_size = size(item)
+            if chunk and total + item_size > limit:
+                chunks.append(chunk)
+                chunk, total = [], 0
+            chunk.append(item)
+            total += item_size
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def batch_get(self, sheet_link:str, ranges:list, **kwargs) -> dict:
+        """Read many ranges, from any sheets of a workbook, with values.batchGet.
+        The ranges are split over as few requests as the URL length allows.
+        Returns a dictionary shaped like a single batchGet response,
+        with the valueRanges in the order of ranges.
+
+        param sheet_link: The hyperlink string to the desired google sheet.
+        type sheet_link: string
+        param ranges: The sheet_name!Range strings to read ie ["Sheet1!A1:C10", "TESTER!J1"]
+        type ranges: list
+        param major_dimension: DEFAULT:=ROWS | See get_from_gsheet.
+        type major_dimension: string
+        param value_render_option: DEFAULT:=FORMATTED_VALUE | See get_from_gsheet.
+        type value_render_option: string
+        param date_time_render_option: DEFAULT=FORMATTED_STRING | See get_from_gsheet.
+        type date_time_render_option: string
+        :rtype: dict
+        """
+        self.service = self._create_connection_and_impersonate()
+        sheetId = max(urlparse(sheet_link).path.split('/'), key = len) # return the longest portion of the parsed sheet_link
+
+        ## DEFAULT PARAMETERS.
+        params = {
+            "major_dimension":"ROWS",
+            "value_render_option":"FORMATTED_VALUE",
+            "date_time_render_option":"FORMATTED_STRING"
+            }
+
+        if kwargs:
+            params.update({i:kwargs[i] for i in kwargs.keys()})
+
+        results = {"spreadsheetId": sheetId, "valueRanges": []}
+        # Each range goes in the query as &ranges=<quoted range>.
+        for chunk in self._chunks(ranges, lambda r: len(quote(r, safe='')) + 8, self.BATCH_GET_URL_LIMIT):
+            response = self.service.spreadsheets().values().batchGet(
+                            spreadsheetId        = sheetId,
+                            ranges               = chunk,
+                            majorDimension       = params["major_dimension"],
+                            valueRenderOption    = params["value_render_option"],
+                            dateTimeRenderOption = params["date_time_render_option"]
+                            ).execute()
+            results["valueRanges"].extend(response.get("valueRanges", []))
+        return results
+
+    def batch_write(self, sheet_link:str, range_data:dict, **kwargs) -> dict:
+        """Write many ranges, to any sheets of a workbook, with values.batchUpdate.
+        The ranges are split over as few requests as the payload limit allows;
+        a single range bigger than the limit is still sent on its own.
+        Returns a dictionary shaped like a single batchUpdate response,
+        with the totals summed over the requests.
+
+        param sheet_link: A string that contains the sheet you wish to update
+        type sheet_link: string
+        param range_data: {sheet_name!Range: data} where data is a pandas
+        DataFrame, written with its column names as the first row,
+        or a list of rows ie {"Sheet1!A1": data_frame, "TESTER!J1": [[current_date]]}
+        type range_data: dict
+        param value_input_option: DEFAULT: RAW | See write_to_gsheet.
+        type value_input_option: string
+        param major_dimension: DEFAULT=ROWS
+        type major_dimension: string
+        param clear: DEFAULT=False | Clear every range with one values.batchClear
+        before writing, as OVERWRITE does in write_to_gsheet.
+        type clear: bool
+        :rtype: dict
+        """
+        self.service = self._create_connection_and_impersonate()
+        sID = max(urlparse(sheet_link).path.split('/'), key = len) # returns the longest portion of the parsed sheet_link
+
+        ## DEFAULT PARAMETERS.
+        params = {
+            "value_input_option":"RAW",
+            "major_dimension":"ROWS",
+            "clear":False
+            }
+
+        if kwargs:
+            params.update({i:kwargs[i] for i in kwargs.keys()})
+
+        value_ranges = [
+            {
+                "range":          sheet_range,
+                "majorDimension": params["major_dimension"],
+                "values":         self._table_values(table_data, header=True)
+            }
+            for sheet_range, table_data in range_data.items()
+        ]
+
+        if params["clear"]:
+            for chunk in self._chunks(list(range_data), lambda r: len(json.dumps(r)) + 1, self.BATCH_PAYLOAD_LIMIT):
+                self.service.spreadsheets().values().batchClear(
+                                        spreadsheetId = sID,
+                                        body          = {"ranges": chunk}
+                                        ).execute()
+
+        results = {
+            "spreadsheetId": sID,
+            "totalUpdatedRows": 0,
+            "totalUpdatedColumns": 0,
+            "totalUpdatedCells": 0,
+            "totalUpdatedSheets": 0,
+            "responses": []
+            }
+        for chunk in self._chunks(value_ranges, lambda v: len(json.dumps(v, default=str)) + 1, self.BATCH_PAYLOAD_LIMIT):
+            response = self.service.spreadsheets().values().batchUpdate(
+                                        spreadsheetId = sID,
+                                        body          = {
+                                            "valueInputOption": params["value_input_option"],
+                                            "data":             chunk
+                                            }
+                                        ).execute()
+            for total in ("totalUpdatedRows", "totalUpdatedColumns", "totalUpdatedCells", "totalUpdatedSheets"):
+                results[total] += response.get(total, 0)
+            results["responses"].extend(response.get("responses", []))
+        return results
+
     def create_new_sheet(self, sheet_link:str, new_sheet_name:str) -> None:
         """Create a new Google Sheet.
 